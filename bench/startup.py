@@ -0,0 +1,129 @@
+# coding=UTF-8
+"""Startup time of the finja entry points.
+
+Indexes a copy of README.rst in a temporary directory and runs each entry
+point in a new interpreter, the best of --runs runs is reported with the
+indexing-only modules the entry point imported.
+
+    python bench/startup.py --runs 20
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only indexing needs, the search and helper entry points shouldn't
+# import them
+_heavy = [
+    "binaryornot",
+    "chardet",
+    "hashlib",
+    "mmap",
+    "multiprocessing",
+]
+
+_report = """
+import atexit
+import sys
+
+def report():
+    heavy = [x for x in {heavy!r} if x in sys.modules]
+    sys.stderr.write("heavy:%s\\n" % ",".join(heavy))
+
+atexit.register(report)
+sys.argv = [{name!r}] + {argv!r}
+import finja
+finja.{func}()
+"""
+
+_cases = [
+    ("python", None, None, []),
+    ("import finja", "finja", None, []),
+    ("finjacol", "finjacol", "col_main", []),
+    ("finjagrep", "finjagrep", "grep_main", []),
+    ("finja -r huhu", "finja", "main", ["-r", "huhu"]),
+    ("finja huhu", "finja", "main", ["huhu"]),
+    ("finjac -r huhu", "finjac", "client_main", ["-r", "huhu"]),
+]
+
+
+def command(name, func, argv):
+    if name is None:
+        return [sys.executable, "-c", "pass"]
+    if func is None:
+        return [sys.executable, "-c", "import finja"]
+    return [sys.executable, "-c", _report.format(
+        heavy=_heavy,
+        name=name,
+        argv=argv,
+        func=func,
+    )]
+
+
+def run(cmd, cwd, env):
+    """Returns the wall time and stderr of the command"""
+    start = time.time()
+    proc = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    _, err = proc.communicate(b"")
+    return time.time() - start, err.decode("UTF-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--runs',
+        '-n',
+        help='runs per entry point. Default: 10',
+        default=10,
+        type=int
+    )
+    args = parser.parse_args()
+    env = dict(os.environ)
+    # Installed packages have their bytecode, don't compile every run
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [_root] + [x for x in [env.get("PYTHONPATH")] if x]
+    )
+    tmp = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(_root, "README.rst"), tmp)
+        # Compile the bytecode and create the index
+        subprocess.check_call(
+            [sys.executable, "-c", "import finja; finja.main(['-i', '-q'])"],
+            cwd=tmp,
+            env=env,
+            stdout=subprocess.PIPE,
+        )
+        print("%-16s %9s  %s" % (
+            "entry point", "best ms", "indexing modules"
+        ))
+        for title, name, func, argv in _cases:
+            cmd  = command(name, func, argv)
+            best = None
+            for _ in range(args.runs):
+                elapsed, err = run(cmd, tmp, env)
+                if best is None or elapsed < best:
+                    best = elapsed
+            heavy = ""
+            for line in err.splitlines():
+                if line.startswith("heavy:"):
+                    heavy = line[6:]
+            print("%-16s %9.1f  %s" % (title, best * 1000, heavy))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,39 @@
 # coding=UTF-8
-import argparse
 import codecs
-import hashlib
+import collections
+import contextlib
+import copy
+import errno
+import heapq
+import itertools
 import math
 import os
-import pickle
 import re
 import sqlite3
 import stat
 import sys
 import time
+import zlib
 
 import six
-from binaryornot.check import is_binary
-from chardet.universaldetector import UniversalDetector
-from termcolor import colored
+
+# Modules only needed to index (binaryornot, chardet, hashlib, mmap,
+# multiprocessing), to format the output (termcolor), to parse the arguments
+# (argparse), for sharded searches (threading) or for the daemon (json,
+# socket) are imported where they are used. The search and helper entry
+# points start faster without them
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    from scandir import scandir
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover
+    import sre_constants
+    import sre_parse
 
 logo = """
 
@@ -36,7 +55,7 @@ logo = """
           \)
 """
 
-_database_version = 4
+_database_version = 12
 
 # If the user pipes we write our internal encoding which is UTF-8
 # This is one of the great things about Python 3, no more hacky hacky
@@ -69,29 +88,102 @@ _pgrs_rotation   = [
 _pgrs_mod1 = len(_pgrs_rotation[0])
 _pgrs_mod2 = 71  # only supersingular primes work
 
-_positive_word_match = re.compile("\w+")
-
 _whitespace_split = " \t\n\r"
 _semantic_split = "\~\^$&#%=,:;!\?\+\"'\`\´*/\\\(\)<>{}\[\]\|"
 _interpunct_split = "··᛫•‧∘∙⋅●◦⦁⸰・･𐂧ּ⸱"
 
-_positive_regex = [
-    _positive_word_match,
-]
+_positive_regex = []
 
 _split_regex = []
 
 _cache_size = 1024 * 1024
 
+_cache_bytes = 192 * 1024 * 1024
+
+# Estimate for the OrderedDict node and the id
+_cache_entry_overhead = 96
+
+# Below the SQLite default of 999 host parameters
+_sql_chunk = 500
+
+# Maximum number of tokens a pattern expands to
+_max_expansion = 1024
+
+# A search term with fewer postings is intersected with the other terms in
+# Python
+_intersect_limit = 10000
+
+# Pages released per incremental_vacuum step, 4 MiB with the default page
+# size
+_vacuum_pages = 1024
+
+# Page cache of a bulk build
+_bulk_cache = 512 * 1024 * 1024
+
+_mmap_threshold = 4 * 1024 * 1024
+
 _db_cache = None
 
-_do_second_pass = False
+# The database this process writes, the shards of an index are FINJA and
+# FINJA.shard1 ... FINJA.shard<N-1>
+_db_path = "FINJA"
+
+_shard = 0
+
+_shards = 1
+
+_shard_cache = {}
+
+# Index the trigrams of the content for --substring and --regex
+_trigrams = False
+
+# Content hash functions, the one used is stored in the database. The
+# functions available are loaded by hash_functions()
+
+_hash_names = ("blake2b", "md5", "sha1", "xxh64")
+
+_hash_functions = None
+
+if sys.version_info >= (3, 6):
+    _default_hash = "blake2b"
+else:  # pragma: no cover
+    _default_hash = "md5"
+
+_hash_name = _default_hash
+
+_pool = None
+
+_pool_chunk = 16
+
+_pending = []
+
+_file_state = {}
+
+_seen_files = set()
+
+_released_content = set()
+
+_writer_files = 0
+
+_writer_bytes = 0
 
 _ignore_dir = set([
     "__pycache__",
     "__MACOSX",
 ])
 
+_index_files = set([
+    "FINJA",
+    "FINJA.lst",
+    "FINJA.ignore",
+    "FINJA-journal",
+    "FINJA-wal",
+    "FINJA-shm",
+    "FINJA.tmp",
+    "FINJA.tmp-journal",
+    "FINJA.sock",
+])
+
 # Very common binary files and annoying text-files like svg
 
 _ignore_ext = set([
@@ -141,20 +233,49 @@ _ignore_ext = set([
 
 _args = None
 
+_timer = getattr(time, "perf_counter", time.time)
+
 _index_count = 0
 
 _cwd = os.getcwd()
 
 _finja_path = None
 
+# Socket of the query daemon, next to FINJA
+_socket_path = "FINJA.sock"
+
+# The daemon answers each request in a thread, the state of the request is
+# thread-local
+_serving = False
+
+_request = None
+
+# Connections of the daemon that no request is using
+_serve_idle = []
+
+_serve_lock = None
+
+# Seconds a client has to send its request and to read a frame of the output
+_serve_timeout = 10
+
+_serve_output_timeout = 300
+
+# Output of a request is sent in frames of about this size
+_serve_frame = 64 * 1024
+
+# Page cache of the daemon's connections
+_serve_cache = 256 * 1024 * 1024
+
 # Regex
 
 
 def prepare_regex(interpunct=False):
+    global _positive_regex
     global _split_regex
     interpunct_split = ""
     if interpunct:
         interpunct_split = _interpunct_split
+    _positive_regex = [re.compile("\w+")]
     _split_regex = []
     _split_regex.append(re.compile("[%s]" % _whitespace_split))
     _split_regex.append(re.compile("[.\_\-%s%s%s]" % (
@@ -185,39 +306,166 @@ class DatabaseKey(object):
     INTERPUNCT = 0
     MAX_ID     = 1
     VERSION    = 2
+    HASH       = 3
+    SHARDS     = 4
+    TRIGRAMS   = 5
 
 
 def cleanup(string):
     string = string.strip()
     if len(string) < 2:
         return None
-    if len(string) <= 16:
-        return string.lower()
-    key = hashlib.md5(string.lower().encode("UTF-8")).digest()
-    if six.PY2:
-        return sqlite3.Binary(key)
-    else:
-        return key
+    return string.lower()
+
+
+def token_key(token):
+    """Long tokens are stored as hash, their text is in the long_token
+    table"""
+    if len(token) <= 16:
+        return token
+    import hashlib
+    return hashlib.md5(token.encode("UTF-8")).digest()
+
+
+def sql_token(token):
+    """Hashed tokens are stored as BLOB"""
+    if six.PY2 and isinstance(token, bytes):
+        return sqlite3.Binary(token)
+    return token
 
 
-def md5(fname):
-    hash = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            hash.update(chunk)
+def trigrams(text):
+    """The distinct trigrams of text, a trigram is stored as integer of three
+    21 bit code points"""
+    return set([
+        (ord(a) << 42) | (ord(b) << 21) | ord(c)
+        for a, b, c in set(zip(text, text[1:], text[2:]))
+    ])
+
+
+def load_file(fname):
+    """Read a file once for hashing, the binary check, encoding detection
+    and tokenizing. Big files are memory-mapped"""
+    import mmap
+    with _stats.timer("read"), open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= _mmap_threshold:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):  # pragma: no cover
+                pass
+        return f.read()
+
+
+def hash_functions():
+    """The available content hash functions by name"""
+    global _hash_functions
+    if _hash_functions is not None:
+        return _hash_functions
+    import hashlib
+    functions = {
+        "md5": hashlib.md5,
+        "sha1": hashlib.sha1,
+    }
+    if hasattr(hashlib, "blake2b"):
+        functions["blake2b"] = lambda: hashlib.blake2b(digest_size=16)
+    try:
+        import xxhash
+        functions["xxh64"] = xxhash.xxh64
+    except ImportError:  # pragma: no cover
+        pass
+    _hash_functions = functions  # noqa
+    return functions
+
+
+def check_hash(hash_name):
+    if hash_name not in hash_functions():
+        raise ValueError("Hash function %s is not available" % hash_name)
+
+
+def content_hash(data, hash_name=None):
+    """Hash with the function of the index, workers get its name with the
+    file"""
+    with _stats.timer("hash"):
+        hash_ = hash_functions()[hash_name or _hash_name]()
+        hash_.update(data)
     if six.PY2:
-        return sqlite3.Binary(hash.digest())
+        return sqlite3.Binary(hash_.digest())
     else:
-        return hash.digest()
+        return hash_.digest()
+
+
+def is_binary_data(fname, data):
+    """Same as binaryornot's is_binary, but on data we already read"""
+    from binaryornot.helpers import is_binary_string
+    try:
+        from binaryornot.helpers import has_binary_extension
+    except ImportError:  # pragma: no cover
+        has_binary_extension = None
+    try:
+        from binaryornot.helpers import CHUNK_SIZE as _binary_chunk
+    except ImportError:  # pragma: no cover
+        _binary_chunk = 1024
+    with _stats.timer("binary"):
+        if has_binary_extension and has_binary_extension(fname):
+            return True
+        return is_binary_string(data[:_binary_chunk])
+
+
+def iter_lines(data):
+    """Yield the lines of data like readlines() of a binary file"""
+    pos = 0
+    end = len(data)
+    while pos < end:
+        nl = data.find(b"\n", pos)
+        if nl < 0:
+            nl = end - 1
+        yield data[pos:nl + 1]
+        pos = nl + 1
+
+
+def detect_encoding(data):
+    from chardet.universaldetector import UniversalDetector
+    with _stats.timer("detect"):
+        detector = UniversalDetector()
+        for line in iter_lines(data):
+            detector.feed(line)
+            if detector.done:
+                break
+        detector.close()
+    return detector.result['encoding']
+
+
+def file_signature(stat_res):
+    """Cheap signature to detect changed files, the content is only hashed if
+    the signature changed"""
+    try:
+        mtime = stat_res.st_mtime_ns
+        ctime = stat_res.st_ctime_ns
+    except AttributeError:  # pragma: no cover
+        mtime = int(stat_res.st_mtime * 1000000000)
+        ctime = int(stat_res.st_ctime * 1000000000)
+    return "%x:%x:%x:%x:%x" % (
+        stat_res.st_dev,
+        stat_res.st_ino,
+        stat_res.st_size,
+        mtime,
+        ctime,
+    )
 
 
+def colored(text, color):
+    """termcolor's colored, termcolor is imported by the first call"""
+    from termcolor import colored
+    return colored(text, color)
+
 # Progress
 
 def progress(flush=True):
     """Write progress to stdout if needed"""
     global _pgrs_last_pos
     global _pgrs_last_time
-    if _args.raw:
+    if current_args().raw:
         return
     now = time.time()
     if (now - _pgrs_last_time) < 0.16:  # noqa
@@ -237,13 +485,14 @@ def progress(flush=True):
 
 # SQL Queries
 
-_string_to_token = """
+_strings_to_tokens = """
     SELECT
+        string,
         id
     FROM
         token
     WHERE
-        string = ?;
+        string IN ({0});
 """
 
 _insert_token = """
@@ -253,261 +502,936 @@ _insert_token = """
         (?, ?);
 """
 
-_token_cardinality = """
+_insert_long_token = """
+    INSERT INTO
+        long_token(id, string)
+    VALUES
+        (?, ?);
+"""
+
+_delete_long_token = """
+    DELETE FROM
+        long_token
+    WHERE
+        id = ?
+"""
+
+_create_long_token_table = """
+    CREATE TABLE
+        long_token(
+            id INTEGER PRIMARY KEY,
+            string TEXT
+        );
+"""
+
+_create_long_token_string_idx = """
+    CREATE INDEX long_token_string_idx ON long_token (string);
+"""
+
+_pattern_tokens = """
+                SELECT
+                    id
+                FROM
+                    token
+                WHERE
+                    string >= ? AND string < ? AND string GLOB ?
+                UNION
+                SELECT
+                    id
+                FROM
+                    long_token
+                WHERE
+                    string >= ? AND string < ? AND string GLOB ?
+                LIMIT ?
+"""
+
+_token_stats = """
     SELECT
-        COUNT(id) count
+        id,
+        refs,
+        files
     FROM
-        finja
+        token
     WHERE
-        token_id = ?
+        string = ?;
+"""
+
+_add_token_refs = """
+    UPDATE
+        token
+    SET
+        refs = refs + ?,
+        files = files + ?
+    WHERE
+        id = ?
+"""
+
+_free_tokens = """
+    SELECT
+        t.id,
+        t.string,
+        l.string
+    FROM
+        token as t
+    LEFT JOIN
+        long_token as l
+    ON
+        t.id = l.id
+    WHERE
+        t.refs <= 0
+        AND
+        t.id IN ({0});
+"""
+
+_delete_token = """
+    DELETE FROM
+        token
+    WHERE
+        id = ?
 """
 
 _search_query = """
     SELECT DISTINCT
-        {projection}
+        f.path,
+        f.id,
+        i.line,
+        c.encoding
     FROM
         finja as i
+    JOIN
+        content as c
+    ON
+        i.content_id = c.id
     JOIN
         file as f
     ON
-        i.file_id = f.id
+        f.id = (
+            SELECT
+                MIN(id)
+            FROM
+                file
+            WHERE
+                content_id = i.content_id
+        )
     {finja_joins}
     WHERE
-        i.token_id=?
+        {first}
     {terms}
     {ignore}
-    {file_mode_hint}
-"""
-
-_clear_found_files = """
-    UPDATE
-        file
-    SET found = 0
+    ORDER BY
+        f.path,
+        i.line
+    {limit}
 """
 
-_clear_inodes = """
-    UPDATE
-        file
-    SET inode_mod = null
+_file_mode_term = """
+            SELECT
+                content_id
+            FROM
+                file_token
+            WHERE
+                {condition}
 """
 
-_delete_missing_indexes = """
-    DELETE FROM
-        finja
+_file_mode_query = """
+    SELECT
+        f.path,
+        f.id
+    FROM
+        file as f
     WHERE
-        file_id IN (
+        f.id IN (
             SELECT
-                id
+                MIN(id)
             FROM
                 file
             WHERE
-                found = 0
+                content_id IN (
+    {terms}
+                )
+            GROUP BY
+                content_id
         )
+    {ignore}
+    ORDER BY
+        f.path
+    {limit}
 """
 
-_find_missing_files = """
+_trigram_cardinality = """
     SELECT
         count(*)
     FROM
-        file
+        trigram
     WHERE
-        found = 0;
+        gram = ?
 """
 
-_delete_missing_files = """
-    DELETE FROM
-        file
+_trigram_contents = """
+    SELECT
+        content_id
+    FROM
+        trigram
     WHERE
-        id IN (
+        gram = ?
+        {contents}
+"""
+
+_content_files = """
+    SELECT
+        f.path,
+        f.id,
+        c.id,
+        c.encoding
+    FROM
+        content as c
+    JOIN
+        file as f
+    ON
+        f.id = (
             SELECT
-                f.id
+                MIN(id)
             FROM
-                file as f
-            JOIN
-                file as ff
-            ON
-                f.md5 = ff.md5
+                file
             WHERE
-                ff.found = 0
+                content_id = c.id
         )
+    WHERE
+        {contents}
+    {ignore}
 """
 
-_delete_free_tokens = """
-    DELETE FROM
-        token
-    WHERE
-        id IN (
+_grep_all_content = """
+        EXISTS (
             SELECT
-                t.id
+                1
             FROM
-                token as t
-            LEFT JOIN
-                finja as f
-            ON
-                t.id = f.token_id
+                file_token
             WHERE
-                f.token_id is null
+                content_id = c.id
         )
 """
 
-_find_file = """
+_token_postings = """
     SELECT
-        id,
-        inode_mod,
-        md5
+        content_id,
+        line
     FROM
-        file
+        finja
     WHERE
-        path=?;
+        token_id = ?
+        {contents}
 """
 
-_check_for_duplicates = """
+_token_contents = """
     SELECT
-        count(*)
+        content_id
     FROM
-        file
+        file_token
     WHERE
-        md5=?;
+        token_id = ?
+        {contents}
 """
 
-_clear_inode_md5_of_duplicates = """
-    UPDATE
+_load_file_state = """
+    SELECT
+        f.path,
+        f.id,
+        f.signature,
+        c.hash,
+        f.found,
+        f.content_id
+    FROM
+        file as f
+    LEFT JOIN
+        content as c
+    ON
+        f.content_id = c.id
+"""
+
+_delete_file = """
+    DELETE FROM
         file
-    SET
-        inode_mod = null,
-        md5 = null
     WHERE
-        md5=?;
+        id = ?
 """
 
-_create_new_file_entry = """
-    INSERT INTO
-        file(path, md5, inode_mod, found)
-    VALUES
-        (?, ?, ?, 1);
+_clear_signatures = """
+    UPDATE
+        file
+    SET signature = null
 """
 
-_update_file_entry = """
-    UPDATE
+_content_in_use = """
+    SELECT
+        count(*)
+    FROM
         file
-    SET
-        md5 = ?,
-        inode_mod = ?,
-        found = 1
     WHERE
-        id = ?
+        content_id = ?;
 """
 
-_clear_existing_index = """
+_find_orphaned_content = """
+    SELECT
+        c.id
+    FROM
+        content as c
+    LEFT JOIN
+        file as f
+    ON
+        c.id = f.content_id
+    WHERE
+        f.id is null
+"""
+
+_delete_content_index = """
     DELETE FROM
         finja
     WHERE
-        file_id=?;
+        content_id = ?;
 """
 
-_insert_index = """
-    INSERT INTO
-        finja(token_id, file_id, line)
-    VALUES
-        (?, ?, ?);
+_delete_content_file_tokens = """
+    DELETE FROM
+        file_token
+    WHERE
+        content_id = ?;
 """
 
-_update_file_info = """
-    UPDATE
-        file
-    SET
-        found = 1,
-        encoding = ?
+_delete_content_trigrams = """
+    DELETE FROM
+        trigram
     WHERE
-        path = ?
+        content_id = ?;
 """
 
-_mark_found = """
+_delete_content = """
+    DELETE FROM
+        content
+    WHERE
+        id = ?;
+"""
+
+_count_token_refs = """
     UPDATE
-        file
+        token
     SET
-        found = 1
-    WHERE
-        path = ?
+        refs = (
+            SELECT
+                count(*)
+            FROM
+                finja
+            WHERE
+                finja.token_id = token.id
+        ),
+        files = (
+            SELECT
+                count(*)
+            FROM
+                file_token
+            WHERE
+                file_token.token_id = token.id
+        );
 """
 
-_find_duplicates = """
+_content_token_refs = """
     SELECT
-        f.path
+        token_id,
+        count(*)
     FROM
-        file as f
-    JOIN
-        file as ff
-    ON
-        ff.md5 = f.md5
+        finja
     WHERE
-        ff.id = ?
-        AND
-        f.id != ?
-"""
-
-_set_key = """
-    INSERT OR REPLACE INTO
-        key_value(key, value)
-    VALUES(?, ?)
+        content_id = ?
+    GROUP BY
+        token_id
 """
 
-_get_key = """
+_find_content = """
     SELECT
-        value
+        id
     FROM
-        key_value
+        content
     WHERE
-        key = ?
+        hash=?;
 """
 
-# Cache classes
-
-
-class TokenDict(dict):
-    def __init__(self, db, *args, **kwargs):
-        super(TokenDict, self).__init__(*args, **kwargs)
-        self.db = db
-        self.token_id = 41
-        self.bulk_insert = []
-        res = get_key(DatabaseKey.MAX_ID, con=self.db)
-        if res:
-            self.token_id = res
+_create_content = """
+    INSERT INTO
+        content(hash)
+    VALUES
+        (?);
+"""
 
-    def __missing__(self, key):
-        with self.db:
-            cur = self.db.cursor()
-            res = cur.execute(_string_to_token, (key,)).fetchall()
-            if res:
-                ret = res[0][0]
-            else:
-                self.token_id += 1
-                ret = self.token_id
-                self.bulk_insert.append((ret, key))
-        self[key] = ret
-        return ret
+_create_new_file_entry = """
+    INSERT INTO
+        file(path, content_id, signature, found)
+    VALUES
+        (?, ?, ?, 1);
+"""
+
+_update_file_entry = """
+    UPDATE
+        file
+    SET
+        content_id = ?,
+        signature = ?,
+        found = 1
+    WHERE
+        id = ?
+"""
+
+_reset_unwritten_files = """
+    UPDATE
+        file
+    SET
+        signature = null,
+        content_id = null
+    WHERE
+        content_id = ?;
+"""
+
+_create_token_id_idx = """
+    CREATE INDEX token_id_idx ON token (id);
+"""
+
+_create_content_table = """
+    CREATE TABLE
+        content(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash BLOB,
+            encoding TEXT
+        );
+"""
+
+_create_content_hash_idx = """
+    CREATE UNIQUE INDEX content_hash_idx ON content (hash);
+"""
+
+_create_file_table = """
+    CREATE TABLE
+        file(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT,
+            content_id INTEGER,
+            signature TEXT,
+            found INTEGER DEFAULT 1
+        );
+"""
+
+_create_file_indexes = [
+    "CREATE INDEX file_path_idx ON file (path);",
+    "CREATE INDEX file_found_idx ON file (found);",
+    "CREATE INDEX file_content_idx ON file (content_id);",
+]
+
+_create_postings = """
+    CREATE TABLE
+        finja(
+            token_id INTEGER,
+            content_id INTEGER,
+            line INTEGER,
+            PRIMARY KEY (token_id, content_id, line)
+        ) WITHOUT ROWID;
+"""
+
+_create_postings_content_idx = """
+    CREATE INDEX finja_content_line_idx ON finja (content_id, line);
+"""
+
+_create_file_tokens = """
+    CREATE TABLE
+        file_token(
+            token_id INTEGER,
+            content_id INTEGER,
+            PRIMARY KEY (token_id, content_id)
+        ) WITHOUT ROWID;
+"""
+
+_create_bulk_postings = """
+    CREATE TABLE
+        finja(
+            token_id INTEGER,
+            content_id INTEGER,
+            line INTEGER
+        );
+"""
+
+_create_bulk_file_tokens = """
+    CREATE TABLE
+        file_token(
+            token_id INTEGER,
+            content_id INTEGER
+        );
+"""
+
+_sort_bulk_postings = """
+    INSERT INTO
+        finja(token_id, content_id, line)
+    SELECT
+        token_id, content_id, line
+    FROM
+        finja_bulk
+    ORDER BY
+        token_id, content_id, line;
+"""
+
+_sort_bulk_file_tokens = """
+    INSERT INTO
+        file_token(token_id, content_id)
+    SELECT
+        token_id, content_id
+    FROM
+        file_token_bulk
+    ORDER BY
+        token_id, content_id;
+"""
+
+_create_trigrams = """
+    CREATE TABLE
+        trigram(
+            gram INTEGER,
+            content_id INTEGER,
+            PRIMARY KEY (gram, content_id)
+        ) WITHOUT ROWID;
+"""
+
+_create_bulk_trigrams = """
+    CREATE TABLE
+        trigram(
+            gram INTEGER,
+            content_id INTEGER
+        );
+"""
+
+_sort_bulk_trigrams = """
+    INSERT INTO
+        trigram(gram, content_id)
+    SELECT
+        gram, content_id
+    FROM
+        trigram_bulk
+    ORDER BY
+        gram, content_id;
+"""
+
+_create_trigrams_content_idx = """
+    CREATE INDEX trigram_content_idx ON trigram (content_id);
+"""
+
+_insert_trigram = """
+    INSERT INTO
+        trigram(gram, content_id)
+    VALUES
+        (?, ?);
+"""
+
+_create_file_tokens_content_idx = """
+    CREATE INDEX file_token_content_idx ON file_token (content_id);
+"""
+
+_insert_file_token = """
+    INSERT INTO
+        file_token(token_id, content_id)
+    VALUES
+        (?, ?);
+"""
+
+_insert_index = """
+    INSERT INTO
+        finja(token_id, content_id, line)
+    VALUES
+        (?, ?, ?);
+"""
+
+_update_content_info = """
+    UPDATE
+        content
+    SET
+        encoding = ?
+    WHERE
+        id = ?
+"""
+
+_mark_found = """
+    UPDATE
+        file
+    SET
+        found = 1
+    WHERE
+        path = ?
+"""
+
+_find_duplicates = """
+    SELECT
+        ff.path,
+        f.path
+    FROM
+        file as ff
+    JOIN
+        file as f
+    ON
+        f.content_id = ff.content_id
+    WHERE
+        ff.path IN ({paths})
+        AND
+        f.id != ff.id
+    ORDER BY
+        ff.path,
+        f.path
+"""
+
+_set_key = """
+    INSERT OR REPLACE INTO
+        key_value(key, value)
+    VALUES(?, ?)
+"""
+
+_get_key = """
+    SELECT
+        value
+    FROM
+        key_value
+    WHERE
+        key = ?
+"""
+
+# Instrumentation
+
+
+class IndexStats(object):
+    """Time spent per indexing phase and throughput counters"""
+
+    phases = (
+        "walk",
+        "stat",
+        "read",
+        "hash",
+        "binary",
+        "detect",
+        "tokenize",
+        "trigrams",
+        "resolve",
+        "insert",
+        "commit",
+    )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times      = dict.fromkeys(self.phases, 0.0)
+        self.files      = 0
+        self.indexed_   = 0
+        self.bytes      = 0
+        self.postings   = 0
+        self.new_tokens = 0
+        self.start      = _timer()
+        self.end        = None
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = _timer()
+        try:
+            yield
+        finally:
+            self.times[phase] += _timer() - start
+
+    def timed_walk(self, walker):
+        """Time a walker, without the stat calls it times itself"""
+        times = self.times
+        walker = iter(walker)
+        while True:
+            start = _timer()
+            stat_time = times["stat"]
+            try:
+                item = next(walker)
+            except StopIteration:
+                times["walk"] += _timer() - start
+                return
+            times["walk"] += _timer() - start - (times["stat"] - stat_time)
+            yield item
+
+    def merge(self, times):
+        """Add the phase times of a worker"""
+        for phase, seconds in six.iteritems(times):
+            self.times[phase] += seconds
+
+    def state(self):
+        """Times and counters to add to the stats of another process"""
+        return (
+            self.times,
+            self.files,
+            self.indexed_,
+            self.bytes,
+            self.postings,
+            self.new_tokens,
+        )
+
+    def add(self, state):
+        times, files, indexed, bytes_, postings, new_tokens = state
+        self.merge(times)
+        self.files      += files
+        self.indexed_   += indexed
+        self.bytes      += bytes_
+        self.postings   += postings
+        self.new_tokens += new_tokens
+
+    def seen(self):
+        self.files += 1
+
+    def read(self, size):
+        self.bytes += size
+
+    def indexed(self, postings, new_tokens):
+        self.indexed_   += 1
+        self.postings   += postings
+        self.new_tokens += new_tokens
+
+    def stop(self):
+        self.end = _timer()
+
+    def summary(self, token_dict=None):
+        seconds = (self.end or _timer()) - self.start
+        rate = 1.0 / max(seconds, 0.000001)
+        res = {
+            "seconds": seconds,
+            "files": self.files,
+            "indexed": self.indexed_,
+            "bytes": self.bytes,
+            "postings": self.postings,
+            "new_tokens": self.new_tokens,
+            "files_per_second": self.files * rate,
+            "indexed_per_second": self.indexed_ * rate,
+            "bytes_per_second": self.bytes * rate,
+            "postings_per_second": self.postings * rate,
+            "new_tokens_per_second": self.new_tokens * rate,
+            "phases": dict(self.times),
+        }
+        if token_dict is not None:
+            res["token_cache"] = token_dict.counters()
+        return res
+
+    def report(self):
+        summary = self.summary()
+        phases = ", ".join([
+            "%s %.2fs" % (x, self.times[x]) for x in self.phases
+        ])
+        return "%s files, %s indexed in %.2fs (%.1f files/s, %.2f MiB/s, " \
+            "%.0f postings/s, %.0f new tokens/s)\nPhases: %s" % (
+                summary["files"],
+                summary["indexed"],
+                summary["seconds"],
+                summary["files_per_second"],
+                summary["bytes_per_second"] / (1024.0 * 1024.0),
+                summary["postings_per_second"],
+                summary["new_tokens_per_second"],
+                phases,
+            )
+
+    def write_json(self, path, token_dict=None):
+        import json
+        with open(path, "w") as f:
+            json.dump(self.summary(token_dict), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+_stats = IndexStats()
+
+# Cache classes
+
+
+class TokenDict(object):
+    """Bounded LRU cache of token ids backed by the token table.
+
+    The cache is limited by entries and by an estimate of its size in bytes.
+    New tokens stay pinned until they are committed to the token table."""
+
+    def __init__(self, db, max_entries=None, max_bytes=None):
+        self.db          = db
+        self.token_id    = 41
+        self.bulk_insert = []
+        self.pending     = {}
+        self.cache       = collections.OrderedDict()
+        self.size        = 0
+        self.max_entries = max_entries or _cache_size
+        self.max_bytes   = max_bytes or _cache_bytes
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        # A bulk build counts the references at the end
+        self.count_refs  = True
+        res = get_key(DatabaseKey.MAX_ID, con=self.db)
+        if res:
+            self.token_id = res
+
+    def get(self, key):
+        """Get a cached token id and mark it as recently used"""
+        ret = self.pending.get(key)
+        if ret is None:
+            ret = self.cache.pop(key, None)
+            if ret is None:
+                return None
+            self.cache[key] = ret
+        self.hits += 1
+        return ret
+
+    def add(self, key, token_id):
+        """Add a token that exists in the token table and evict the least
+        recently used tokens if the cache is full"""
+        cache = self.cache
+        if key not in cache:
+            self.size += sys.getsizeof(key) + _cache_entry_overhead
+        cache[key] = token_id
+        while cache and (
+                len(cache) > self.max_entries or self.size > self.max_bytes
+        ):
+            old, _ = cache.popitem(last=False)
+            self.size -= sys.getsizeof(old) + _cache_entry_overhead
+            self.evictions += 1
+
+    def new(self, key):
+        self.token_id += 1
+        self.pending[key] = self.token_id
+        self.bulk_insert.append((self.token_id, key))
+        return self.token_id
+
+    def discard(self, key):
+        """Remove a deleted token from the cache"""
+        token_id = self.cache.pop(key, None)
+        if token_id is not None:
+            self.size -= sys.getsizeof(key) + _cache_entry_overhead
+
+    def clear(self):
+        self.cache.clear()
+        self.size = 0
+
+    def reference(self, refs):
+        """Add the references (token id -> postings) of the postings of new
+        content, each token is also counted in one more content"""
+        if not self.count_refs:
+            return
+        self.db.executemany(
+            _add_token_refs, [(y, 1, x) for x, y in six.iteritems(refs)]
+        )
+
+    def release(self, refs, files):
+        """Remove the references (token id -> postings) and the content
+        counts (token id -> content) of deleted content. Tokens without
+        references are deleted.
+
+        Returns the number of deleted tokens"""
+        self.db.executemany(_add_token_refs, [
+            (-y, -files[x], x) for x, y in six.iteritems(refs)
+        ])
+        token_ids = list(refs)
+        free      = []
+        for pos in range(0, len(token_ids), _sql_chunk):
+            chunk = token_ids[pos:pos + _sql_chunk]
+            query = _free_tokens.format(", ".join(["?"] * len(chunk)))
+            free.extend(self.db.execute(query, chunk).fetchall())
+        for _, string, long_string in free:
+            if long_string is not None:
+                self.discard(long_string)
+            elif isinstance(string, six.text_type):
+                self.discard(string)
+            else:
+                # A long token indexed before its text was stored
+                self.clear()
+        free = [(x,) for x, _, _ in free]
+        self.db.executemany(_delete_token, free)
+        self.db.executemany(_delete_long_token, free)
+        return len(free)
+
+    def resolve(self, tokens):
+        """Resolve many tokens with chunked IN queries, unseen tokens get
+        new ids in bulk. Tokens are assigned ids in the given order.
+
+        Returns a dict of the resolved token ids"""
+        ids     = {}
+        missing = []
+        for token in tokens:
+            token_id = self.get(token)
+            if token_id is None:
+                missing.append(token)
+            else:
+                ids[token] = token_id
+        self.misses += len(missing)
+        found   = {}
+        for pos in range(0, len(missing), _sql_chunk):
+            chunk = missing[pos:pos + _sql_chunk]
+            keys  = dict([(token_key(x), x) for x in chunk])
+            query = _strings_to_tokens.format(", ".join(["?"] * len(chunk)))
+            for string, token_id in self.db.execute(
+                    query, [sql_token(x) for x in keys]
+            ):
+                if not isinstance(string, six.text_type):
+                    string = bytes(string)
+                found[keys[string]] = token_id
+        for token in missing:
+            token_id = found.get(token)
+            if token_id is None:
+                token_id = self.new(token)
+            else:
+                self.add(token, token_id)
+            ids[token] = token_id
+        return ids
 
     def commit(self):
         if self.token_id >= 2 ** 63 - 1:
             ValueError("Out of token-space. Delete the database and reindex")
-        bulk_insert = self.bulk_insert
+        bulk_insert = [
+            (x, sql_token(token_key(y))) for x, y in self.bulk_insert
+        ]
         new = len(bulk_insert)
         self.db.executemany(_insert_token, bulk_insert)
+        self.db.executemany(_insert_long_token, [
+            (x, y) for x, y in self.bulk_insert if len(y) > 16
+        ])
+        self.db.execute(
+            _set_key, (DatabaseKey.MAX_ID, dump_value(self.token_id))
+        )
+        # Committed tokens can be evicted now
+        for token_id, key in self.bulk_insert:
+            self.add(key, token_id)
         self.bulk_insert = []
-        set_key(DatabaseKey.MAX_ID, self.token_id, con=self.db)
+        self.pending     = {}
         return new
 
+    def counters(self):
+        return {
+            "entries": len(self.cache),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def stats(self):
+        return "Token cache: %s entries, %.1f MiB, hits: %s misses: %s " \
+            "evictions: %s" % (
+                len(self.cache),
+                self.size / (1024.0 * 1024.0),
+                self.hits,
+                self.misses,
+                self.evictions,
+            )
+
 # DB functions
 
 
-def set_key(key, value, con=None):
+def dump_value(value):
+    import pickle
     bin_value = pickle.dumps(value)
     if six.PY2:
         bin_value = sqlite3.Binary(bin_value)
+    return bin_value
+
+
+def set_key(key, value, con=None):
     if not con:
         con = get_db()[0]
     with con:
-        con.execute(_set_key, (key, bin_value))
+        con.execute(_set_key, (key, dump_value(value)))
 
 
 def get_key(key, con=None):
@@ -516,82 +1440,546 @@ def get_key(key, con=None):
     with con:
         res = con.execute(_get_key, (key,)).fetchall()
         if res:
+            import pickle
             return pickle.loads(res[0][0])
         return None
 
 
-def get_db(create=False):
-    global _db_cache
-    if _db_cache:
-        return _db_cache  # noqa
-    exists = os.path.exists("FINJA")
+def migrate(con, version):
+    """Migrate the database to the next version in one transaction"""
+    sys.stderr.write("Migrating FINJA from version %s\n" % version)
+    ilevel = con.isolation_level
+    # Python's sqlite3 doesn't put DDL statements into transactions
+    con.isolation_level = None
+    try:
+        con.execute("BEGIN")
+        version = _migrations[version](con)
+        con.execute(
+            _set_key, (DatabaseKey.VERSION, dump_value(version))
+        )
+        con.execute("COMMIT")
+    except:  # noqa
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.isolation_level = ilevel
+    return version
+
+
+def migrate_4(con):
+    """Replace inode_mod by a signature and md5 by hash"""
+    con.execute("""
+        CREATE TABLE
+            file_new(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT,
+                hash BLOB,
+                signature TEXT,
+                found INTEGER DEFAULT 1,
+                encoding TEXT
+            );
+    """)
+    # The signature is unknown, so all files are hashed once
+    con.execute("""
+        INSERT INTO
+            file_new(id, path, hash, signature, found, encoding)
+        SELECT
+            id, path, md5, null, found, encoding
+        FROM
+            file;
+    """)
+    con.execute("DROP TABLE file;")
+    con.execute("ALTER TABLE file_new RENAME TO file;")
+    con.execute("""
+        CREATE INDEX file_hash_idx ON file (hash);
+    """)
+    con.execute("""
+        CREATE INDEX file_path_idx ON file (path);
+    """)
+    con.execute("""
+        CREATE INDEX file_found_idx ON file (found);
+    """)
+    # Keep the existing hashes valid
+    con.execute(_set_key, (DatabaseKey.HASH, dump_value("md5")))
+    return 5
+
+
+def migrate_5(con):
+    """Store the postings clustered on (token_id, file_id, line) without
+    the unused rowid and the redundant indexes"""
+    con.execute("ALTER TABLE finja RENAME TO finja_old;")
+    con.execute("DROP INDEX finja_token_id_idx;")
+    con.execute("DROP INDEX finja_file_idx;")
+    con.execute("DROP INDEX finja_file_line_idx;")
+    con.execute("""
+        CREATE TABLE
+            finja(
+                token_id INTEGER,
+                file_id INTEGER,
+                line INTEGER,
+                PRIMARY KEY (token_id, file_id, line)
+            ) WITHOUT ROWID;
+    """)
+    # Inserting in key order appends to the b-tree
+    con.execute("""
+        INSERT OR IGNORE INTO
+            finja(token_id, file_id, line)
+        SELECT
+            token_id, file_id, line
+        FROM
+            finja_old
+        ORDER BY
+            token_id, file_id, line;
+    """)
+    con.execute("DROP TABLE finja_old;")
+    con.execute("""
+        CREATE INDEX finja_file_line_idx ON finja (file_id, line);
+    """)
+    return 6
+
+
+def migrate_6(con):
+    """Move the file level (line = -1) postings to the file_token table"""
+    con.execute("""
+        CREATE TABLE
+            file_token(
+                token_id INTEGER,
+                file_id INTEGER,
+                PRIMARY KEY (token_id, file_id)
+            ) WITHOUT ROWID;
+    """)
+    con.execute("""
+        INSERT INTO
+            file_token(token_id, file_id)
+        SELECT
+            token_id, file_id
+        FROM
+            finja
+        WHERE
+            line = -1
+        ORDER BY
+            token_id, file_id;
+    """)
+    con.execute("""
+        DELETE FROM
+            finja
+        WHERE
+            line = -1;
+    """)
+    con.execute("""
+        CREATE INDEX file_token_file_idx ON file_token (file_id);
+    """)
+    return 7
+
+
+def migrate_7(con):
+    """Key the postings by content, files with the same hash share one
+    content entry"""
+    con.execute("""
+        CREATE TABLE
+            content(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hash BLOB,
+                encoding TEXT
+            );
+    """)
+    # The file that holds the postings of a hash becomes the content entry,
+    # so the postings keep their ids
+    con.execute("""
+        INSERT INTO
+            content(id, hash, encoding)
+        SELECT
+            f.id, f.hash, f.encoding
+        FROM
+            file as f
+        WHERE
+            f.hash IS NOT null
+            AND
+            f.id = (
+                SELECT
+                    ff.id
+                FROM
+                    file as ff
+                WHERE
+                    ff.hash = f.hash
+                ORDER BY
+                    EXISTS (
+                        SELECT
+                            1
+                        FROM
+                            file_token as t
+                        WHERE
+                            t.file_id = ff.id
+                    ) DESC,
+                    ff.id
+                LIMIT 1
+            );
+    """)
+    con.execute("""
+        CREATE UNIQUE INDEX content_hash_idx ON content (hash);
+    """)
+    con.execute("ALTER TABLE file RENAME TO file_old;")
+    con.execute("DROP INDEX file_hash_idx;")
+    con.execute("DROP INDEX file_path_idx;")
+    con.execute("DROP INDEX file_found_idx;")
+    con.execute("""
+        CREATE TABLE
+            file(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT,
+                content_id INTEGER,
+                signature TEXT,
+                found INTEGER DEFAULT 1
+            );
+    """)
+    con.execute("""
+        INSERT INTO
+            file(id, path, content_id, signature, found)
+        SELECT
+            f.id, f.path, c.id, f.signature, f.found
+        FROM
+            file_old as f
+        LEFT JOIN
+            content as c
+        ON
+            f.hash = c.hash;
+    """)
+    con.execute("DROP TABLE file_old;")
+    con.execute("CREATE INDEX file_path_idx ON file (path);")
+    con.execute("CREATE INDEX file_found_idx ON file (found);")
+    con.execute("CREATE INDEX file_content_idx ON file (content_id);")
+    con.execute("ALTER TABLE finja RENAME TO finja_old;")
+    con.execute("DROP INDEX finja_file_line_idx;")
+    con.execute("""
+        CREATE TABLE
+            finja(
+                token_id INTEGER,
+                content_id INTEGER,
+                line INTEGER,
+                PRIMARY KEY (token_id, content_id, line)
+            ) WITHOUT ROWID;
+    """)
+    # Postings of duplicates that weren't cleaned up are dropped
+    con.execute("""
+        INSERT INTO
+            finja(token_id, content_id, line)
+        SELECT
+            token_id, file_id, line
+        FROM
+            finja_old
+        WHERE
+            file_id IN (SELECT id FROM content)
+        ORDER BY
+            token_id, file_id, line;
+    """)
+    con.execute("DROP TABLE finja_old;")
+    con.execute("""
+        CREATE INDEX finja_content_line_idx ON finja (content_id, line);
+    """)
+    con.execute("ALTER TABLE file_token RENAME TO file_token_old;")
+    con.execute("DROP INDEX file_token_file_idx;")
+    con.execute("""
+        CREATE TABLE
+            file_token(
+                token_id INTEGER,
+                content_id INTEGER,
+                PRIMARY KEY (token_id, content_id)
+            ) WITHOUT ROWID;
+    """)
+    con.execute("""
+        INSERT INTO
+            file_token(token_id, content_id)
+        SELECT
+            token_id, file_id
+        FROM
+            file_token_old
+        WHERE
+            file_id IN (SELECT id FROM content)
+        ORDER BY
+            token_id, file_id;
+    """)
+    con.execute("DROP TABLE file_token_old;")
+    con.execute("""
+        CREATE INDEX file_token_content_idx ON file_token (content_id);
+    """)
+    return 8
+
+
+def migrate_8(con):
+    """Count the postings of each token, so free tokens can be deleted while
+    indexing"""
+    con.execute("""
+        ALTER TABLE token ADD COLUMN refs INTEGER DEFAULT 0;
+    """)
+    con.execute("""
+        CREATE INDEX token_id_idx ON token (id);
+    """)
+    con.execute("""
+        UPDATE
+            token
+        SET
+            refs = (
+                SELECT
+                    count(*)
+                FROM
+                    finja
+                WHERE
+                    finja.token_id = token.id
+            );
+    """)
+    con.execute("""
+        DELETE FROM
+            token
+        WHERE
+            refs = 0;
+    """)
+    return 9
+
+
+def migrate_9(con):
+    """Store the text of long tokens for prefix search. The text of tokens
+    indexed before is unknown, except for the tokens that only got longer
+    than 16 characters by lowercasing"""
+    con.execute("""
+        CREATE TABLE
+            long_token(
+                id INTEGER PRIMARY KEY,
+                string TEXT
+            );
+    """)
+    con.execute("""
+        CREATE INDEX long_token_string_idx ON long_token (string);
+    """)
+    res = con.execute("""
+        SELECT
+            id,
+            string
+        FROM
+            token
+        WHERE
+            typeof(string) = 'text'
+            AND
+            length(string) > 16;
+    """).fetchall()
+    for token_id, string in res:
+        con.execute("""
+            UPDATE OR IGNORE
+                token
+            SET
+                string = ?
+            WHERE
+                id = ?;
+        """, (sql_token(token_key(string)), token_id))
+        con.execute("""
+            INSERT INTO
+                long_token(id, string)
+            VALUES
+                (?, ?);
+        """, (token_id, string))
+    return 10
+
+
+def migrate_10(con):
+    """Add the trigram index, it stays empty until the index is rebuilt with
+    --bulk --trigrams"""
+    con.execute("""
+        CREATE TABLE
+            trigram(
+                gram INTEGER,
+                content_id INTEGER,
+                PRIMARY KEY (gram, content_id)
+            ) WITHOUT ROWID;
+    """)
+    con.execute("""
+        CREATE INDEX trigram_content_idx ON trigram (content_id);
+    """)
+    con.execute(
+        _set_key, (DatabaseKey.TRIGRAMS, dump_value(False))
+    )
+    return 11
+
+
+def migrate_11(con):
+    """Count the content of each token, for the query planner"""
+    con.execute("""
+        ALTER TABLE token ADD COLUMN files INTEGER DEFAULT 0;
+    """)
+    con.execute("""
+        UPDATE
+            token
+        SET
+            files = (
+                SELECT
+                    count(*)
+                FROM
+                    file_token
+                WHERE
+                    file_token.token_id = token.id
+            );
+    """)
+    return 12
+
+
+_migrations = {
+    4: migrate_4,
+    5: migrate_5,
+    6: migrate_6,
+    7: migrate_7,
+    8: migrate_8,
+    9: migrate_9,
+    10: migrate_10,
+    11: migrate_11,
+}
+
+
+def create_tables(
+        connection, interpunct, hash_name, shards, trigrams, bulk=False
+):
+    """Create the tables of a new database. A bulk build creates the
+    postings as plain tables without any indexes, see finish_bulk"""
+    # We use inline queries here
+    if bulk:
+        connection.execute(_create_bulk_postings)
+        connection.execute(_create_bulk_file_tokens)
+        connection.execute(_create_bulk_trigrams)
+    else:
+        connection.execute(_create_postings)
+        connection.execute(_create_postings_content_idx)
+        connection.execute(_create_file_tokens)
+        connection.execute(_create_file_tokens_content_idx)
+        connection.execute(_create_trigrams)
+        connection.execute(_create_trigrams_content_idx)
+    connection.execute("""
+        CREATE TABLE
+            token(
+                string TEXT UNIQUE PRIMARY KEY,
+                id INTEGER,
+                refs INTEGER DEFAULT 0,
+                files INTEGER DEFAULT 0
+            );
+    """)
+    connection.execute(_create_long_token_table)
+    connection.execute(_create_long_token_string_idx)
+    # The content is looked up by hash while indexing
+    connection.execute(_create_content_table)
+    connection.execute(_create_content_hash_idx)
+    connection.execute(_create_file_table)
+    if not bulk:
+        connection.execute(_create_token_id_idx)
+        for index in _create_file_indexes:
+            connection.execute(index)
+    connection.execute("""
+        CREATE TABLE
+            key_value(
+                key INTEGER PRIMARY KEY,
+                value BLOB
+            );
+    """)
+    connection.execute("""
+        CREATE INDEX key_value_key_idx ON key_value (key);
+    """)
+    set_key(DatabaseKey.INTERPUNCT, interpunct, connection)
+    set_key(DatabaseKey.VERSION, _database_version, connection)
+    set_key(DatabaseKey.HASH, hash_name, connection)
+    set_key(DatabaseKey.SHARDS, shards, connection)
+    set_key(DatabaseKey.TRIGRAMS, trigrams, connection)
+
+
+def writing():
+    """Only --index, --update, --vacuum and --bulk write the index"""
+    return bool(_args) and bool(
+        _args.index or _args.update or _args.vacuum or _args.bulk
+    )
+
+
+def can_write(path):
+    directory = os.path.dirname(path) or "."
+    return os.access(path, os.W_OK) and os.access(directory, os.W_OK)
+
+
+def connect_read(path, threads=False):
+    """Connect to a database for searching. If it can't be written it is
+    opened read-only, and as immutable if SQLite can't create the WAL files
+    next to it"""
+    if six.PY2 or can_write(path):  # pragma: no cover
+        return sqlite3.connect(path, check_same_thread=not threads)
+    from six.moves.urllib.request import pathname2url
+    url = "file:%s" % pathname2url(os.path.abspath(path))
+    connection = sqlite3.connect(
+        url + "?mode=ro", uri=True, check_same_thread=not threads
+    )
+    try:
+        connection.execute("SELECT count(*) FROM sqlite_master").fetchall()
+        return connection
+    except sqlite3.OperationalError:
+        connection.close()
+    return sqlite3.connect(
+        url + "?immutable=1", uri=True, check_same_thread=not threads
+    )
+
+
+def open_db(path, create=False, threads=False):
+    """Open (or create) and migrate a database. With threads the connection
+    can be used by other threads, one at a time. Searches don't change the
+    journal mode, they also work on read-only indexes"""
+    exists = os.path.exists(path)
     if not (create or exists):
-        raise ValueError("Could not find FINJA")
-    connection = sqlite3.connect("FINJA")  # noqa
-    connection.execute('PRAGMA encoding = "UTF-8";')
+        raise ValueError("Could not find %s" % path)
+    if not exists:
+        # Before the file is created, an index with a hash that isn't
+        # available couldn't be used
+        hash_name = _args.hash or _default_hash
+        check_hash(hash_name)
+    write = create or writing()
+    if write:
+        connection = sqlite3.connect(  # noqa
+            path, check_same_thread=not threads
+        )
+        connection.execute('PRAGMA encoding = "UTF-8";')
+    else:
+        connection = connect_read(path, threads)
+    if _serving:
+        connection.execute(
+            'PRAGMA cache_size = -%d;' % (_serve_cache // 1024)
+        )
+    if not exists:
+        # Only possible before the first table is created, --vacuum converts
+        # existing databases
+        connection.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    if write:
+        # The writer commits in batches, in WAL mode a commit doesn't need
+        # to fsync the database and readers don't block the writer
+        connection.execute('PRAGMA journal_mode = WAL;')
+        connection.execute('PRAGMA synchronous = NORMAL;')
     if not exists:
-        # We use inline queries here
-        connection.execute("""
-            CREATE TABLE
-                finja(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    token_id INTEGER,
-                    file_id INTEGER,
-                    line INTEGER
-                );
-        """)
-        connection.execute("""
-            CREATE INDEX finja_token_id_idx ON finja (token_id);
-        """)
-        connection.execute("""
-            CREATE INDEX finja_file_idx ON finja (file_id);
-        """)
-        connection.execute("""
-            CREATE INDEX finja_file_line_idx ON finja (file_id, line);
-        """)
-        connection.execute("""
-            CREATE TABLE
-                token(
-                    string TEXT UNIQUE PRIMARY KEY,
-                    id INTEGER
-                );
-        """)
-        connection.execute("""
-            CREATE TABLE
-                file(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    path TEXT,
-                    md5 BLOB,
-                    inode_mod INTEGER,
-                    found INTEGER DEFAULT 1,
-                    encoding TEXT
-                );
-        """)
-        connection.execute("""
-            CREATE INDEX file_md5_idx ON file (md5);
-        """)
-        connection.execute("""
-            CREATE INDEX file_path_idx ON file (path);
-        """)
-        connection.execute("""
-            CREATE INDEX file_found_idx ON file (found);
-        """)
-        connection.execute("""
-            CREATE TABLE
-                key_value(
-                    key INTEGER PRIMARY KEY,
-                    value BLOB
-                );
-        """)
-        connection.execute("""
-            CREATE INDEX key_value_key_idx ON key_value (key);
-        """)
-        set_key(DatabaseKey.INTERPUNCT, _args.interpunct, connection)
-        set_key(DatabaseKey.VERSION, _database_version, connection)
+        create_tables(
+            connection,
+            bool(_args.interpunct),
+            hash_name,
+            _args.shards or 1,
+            bool(_args.trigrams),
+        )
     connection.commit()
     version = get_key(DatabaseKey.VERSION, connection)
+    while version in _migrations:
+        version = migrate(connection, version)
     if version != _database_version:
         raise ValueError("Database version not correct. Please reindex")
+    return connection
+
+
+def get_db(create=False):
+    global _db_cache
+    global _hash_name
+    global _shards
+    handle = request_state("handle")
+    if handle:
+        return handle.db
+    if _db_cache:
+        return _db_cache  # noqa
+    connection = open_db(_db_path, create)
+    _shards = get_key(DatabaseKey.SHARDS, connection) or 1  # noqa
+    _hash_name = get_key(DatabaseKey.HASH, connection)
     _db_cache = (
         connection,
         TokenDict(connection),
@@ -599,82 +1987,127 @@ def get_db(create=False):
     return _db_cache
 
 
-def gen_search_query(pignore, file_mode, terms=1):
-    if file_mode:
-        projection = """
-            f.path,
-            f.id
-        """
-    else:
-        projection = """
-            f.path,
-            f.id,
-            i.line,
-            f.encoding
-        """
-    join_list = []
-    term_list = []
-    if file_mode:
-        file_mode_hint = "AND i.line = -1"
-        for x in range(terms - 1):
-            join_list.append("""
-                JOIN
-                    finja as i{0}
-                ON
-                    i.file_id == i{0}.file_id
-                    AND
-                    i.line = -1
-                    AND
-                    i{0}.line = -1
-            """.format(x))
-    else:
-        file_mode_hint = "AND i.line != -1"
-        for x in range(terms - 1):
-            join_list.append("""
-                JOIN
-                    finja as i{0}
-                ON
-                    i.file_id == i{0}.file_id
-                    AND
-                    i.line == i{0}.line
-                    AND
-                    i.line != -1
-                    AND
-                    i{0}.line != -1
-            """.format(x))
-    for x in range(terms - 1):
-        term_list.append("AND i{0}.token_id = ?".format(x))
+def close_db():
+    """Close the cached connections to the index"""
+    global _db_cache
+    if _db_cache:
+        _db_cache[0].close()
+    for con in _shard_cache.values():
+        con.close()
+    _shard_cache.clear()
+    _db_cache = None  # noqa
+
+
+def shard_path(shard):
+    if shard == 0:
+        return "FINJA"
+    return "FINJA.shard%d" % shard
+
+
+def path_shard(path):
+    """Files are partitioned by the hash of their path"""
+    if _shards == 1:
+        return 0
+    path = path.replace(os.sep, "/").encode("UTF-8")
+    return (zlib.crc32(path) & 0xffffffff) % _shards
+
+
+def shard_con(db, shard):
+    """Connection to a shard, shard 0 is the main database"""
+    if shard == 0:
+        return db[0]
+    handle = request_state("handle")
+    cache  = handle.shard_cons if handle else _shard_cache
+    con    = cache.get(shard)
+    if con is None:
+        con = open_db(shard_path(shard), threads=_serving)
+        cache[shard] = con
+    return con
+
+
+def is_pattern(term):
+    return term is not None and ("*" in term or "?" in term)
+
+
+def pattern_args(pattern):
+    """Arguments of _pattern_tokens: the range of the literal prefix of the
+    pattern and the pattern for GLOB"""
+    prefix = re.split(r"[*?]", pattern, maxsplit=1)[0]
+    glob = pattern.replace("[", "[[]")
+    args = (prefix, prefix + u"\U0010ffff", glob)
+    return args + args + (_max_expansion,)
+
+
+def term_condition(column, pattern):
+    if pattern:
+        return "%s IN (%s)" % (column, _pattern_tokens)
+    return "%s = ?" % column
+
+
+def gen_search_query(pignore, file_mode, patterns, limit=False):
+    """Patterns is a list that is true for the terms that are patterns. The
+    matches are ordered by path and line, with limit the query takes the
+    number of matches as last argument"""
+    limit = "LIMIT ?" if limit else ""
     ignore_list = []
     filter_ = "AND f.path NOT LIKE ?"
     for ignore in pignore:
         ignore_list.append(filter_)
+    if file_mode:
+        # The files containing all terms are the intersection of the files
+        # of each term
+        term_list = [
+            _file_mode_term.format(condition=term_condition("token_id", x))
+            for x in patterns
+        ]
+        return _file_mode_query.format(
+            terms = "\n    INTERSECT\n".join(term_list),
+            ignore = "\n".join(ignore_list),
+            limit = limit,
+        )
+    join_list = []
+    term_list = []
+    for x in range(len(patterns) - 1):
+        join_list.append("""
+            JOIN
+                finja as i{0}
+            ON
+                i.content_id == i{0}.content_id
+                AND
+                i.line == i{0}.line
+        """.format(x))
+    for x, pattern in enumerate(patterns[1:]):
+        term_list.append("AND %s" % term_condition(
+            "i{0}.token_id".format(x), pattern
+        ))
     return _search_query.format(
-        projection = projection,
         ignore = "\n".join(ignore_list),
         finja_joins = "\n".join(join_list),
+        first = term_condition("i.token_id", patterns[0]),
         terms = "\n".join(term_list),
-        file_mode_hint = file_mode_hint
+        limit = limit,
     )
 
 # OS access
 
 
-def get_line(file_path, lineno, file_):
-    line = "!! Bad encoding "
-    try:
-        if file_:
-            file_.seek(0)
-            for _ in range(lineno):
-                line = file_.readline()
-        else:
-            with codecs.open(file_path, "r", encoding="UTF-8") as f:
-                for _ in range(lineno):
-                    line = f.readline()
-    except UnicodeDecodeError:
-        pass
-    except (IOError, OSError):
-        line = "!! File not found "
-    return line
+def read_lines(path, encoding, wanted):
+    """Read the wanted lines of a file in one pass, up to the last wanted
+    line. Returns a dict line number -> line, the lines keep their line
+    ending. Lines from a decoding error on are "!! Bad encoding " """
+    lines = {}
+    last  = max(wanted)
+    with codecs.open(path, "r", encoding=encoding) as f:
+        try:
+            for lineno, line in enumerate(f, 1):
+                if lineno in wanted:
+                    lines[lineno] = line
+                if lineno >= last:
+                    break
+        except UnicodeDecodeError:
+            for lineno in wanted:
+                lines.setdefault(lineno, "!! Bad encoding ")
+    return lines
 
 
 def find_finja():
@@ -694,312 +2127,1281 @@ def find_finja():
 
 
 def index():
-    db = get_db(create=True)
-    do_index(db)
+    configure_shards()
+    token_dict = None
+    if _shards > 1:
+        index_shards()
+    else:
+        if _args.bulk:
+            db = start_bulk()
+        else:
+            db = get_db(create=True)
+        do_index(db)
+        if _args.bulk:
+            finish_bulk(db)
+        token_dict = db[1]
+    if _args.bulk:
+        remove_stale_shards()
+    print(_stats.report())
+    if token_dict is not None:
+        print(token_dict.stats())
     print("Indexing done")
 
 
+def configure_shards():
+    """The number of shards is set by --shards when the index is created or
+    bulk built, else it is read from the manifest in FINJA"""
+    global _shards
+    if _args.bulk or not os.path.exists("FINJA"):
+        shards = None
+        if os.path.exists("FINJA"):
+            old = sqlite3.connect("FINJA")
+            shards = get_key(DatabaseKey.SHARDS, old)
+            old.close()
+        _shards = _args.shards or shards or 1  # noqa
+        if not _args.bulk:
+            get_db(create=True)
+    else:
+        get_db()
+        if _args.shards and _args.shards != _shards:
+            raise ValueError(
+                "FINJA has %s shards, use --bulk to change it" % _shards
+            )
+        if _args.trigrams and not get_key(DatabaseKey.TRIGRAMS):
+            raise ValueError(
+                "FINJA has no trigram index, use --bulk to add it"
+            )
+        if _args.trigrams is False and get_key(DatabaseKey.TRIGRAMS):
+            raise ValueError(
+                "FINJA has a trigram index, use --bulk to remove it"
+            )
+    if _shards > 1 and _args.batch > 0:
+        raise ValueError("--batch can't be used with shards")
+
+
+def index_settings():
+    """The interpunct, hash and trigram settings for new shards: the
+    settings of the existing index, unless they are set by the arguments.
+    --no-interpunct and --no-trigrams turn them off"""
+    interpunct = _args.interpunct
+    hash_name  = _args.hash
+    trigrams   = _args.trigrams
+    if os.path.exists("FINJA"):
+        old = sqlite3.connect("FINJA")
+        if interpunct is None:
+            interpunct = get_key(DatabaseKey.INTERPUNCT, old)
+        hash_name = hash_name or get_key(DatabaseKey.HASH, old)
+        if trigrams is None:
+            trigrams = get_key(DatabaseKey.TRIGRAMS, old)
+        old.close()
+    return bool(interpunct), hash_name or _default_hash, bool(trigrams)
+
+
+def index_shards(update=False):
+    """Index all shards in parallel, one writer process per shard. The
+    memory and the tokenizer processes are divided between the shards"""
+    import multiprocessing
+    _stats.reset()
+    args = copy.copy(_args)
+    args.interpunct, args.hash, args.trigrams = index_settings()
+    args.shards     = _shards
+    args.stats_json = None
+    args.jobs       = max(1, _args.jobs // _shards)
+    caches = (
+        int(_cache_size / _shards),
+        int(_cache_bytes / _shards),
+        int(_bulk_cache / _shards),
+    )
+    # SQLite connections must not be carried across fork(), the parent
+    # reopens the index when it needs it
+    close_db()
+    queue = multiprocessing.Queue()
+    procs = []
+    for shard in range(_shards):
+        proc = multiprocessing.Process(
+            target=index_shard,
+            args=(args, shard, caches, update, queue)
+        )
+        proc.start()
+        procs.append(proc)
+    failed = []
+    for _ in procs:
+        shard, state = queue.get()
+        if state is None:
+            failed.append(shard)
+        else:
+            _stats.add(state)
+    for proc in procs:
+        proc.join()
+    _stats.stop()
+    if failed:
+        if _args.bulk:
+            for shard in range(_shards):
+                if os.path.exists(shard_path(shard) + ".tmp"):
+                    os.remove(shard_path(shard) + ".tmp")
+        raise ValueError("Indexing failed in shard %s" % (
+            ", ".join([str(x) for x in sorted(failed)])
+        ))
+    if _args.bulk:
+        swap_bulk_shards()
+    if _args.stats_json:
+        _stats.write_json(_args.stats_json)
+
+
+def index_shard(args, shard, caches, update, queue):
+    """Index one shard in its own process"""
+    global _args
+    global _db_path
+    global _db_cache
+    global _shard
+    global _shards
+    global _cache_size
+    global _cache_bytes
+    global _bulk_cache
+    _args     = args  # noqa
+    _shard    = shard  # noqa
+    _shards   = args.shards  # noqa
+    _db_path  = shard_path(shard)  # noqa
+    _db_cache = None  # noqa
+    _cache_size, _cache_bytes, _bulk_cache = caches  # noqa
+    state = None
+    try:
+        if args.bulk:
+            db = start_bulk()
+        else:
+            db = get_db(create=True)
+        do_index(db, update)
+        if args.bulk:
+            # The parent swaps the shards when all of them are built
+            build_bulk(db)
+        else:
+            db[0].close()
+        state = _stats.state()
+    finally:
+        queue.put((shard, state))
+
+
+def remove_stale_shards():
+    """Remove the shards a bulk build with fewer shards left over"""
+    shard = max(_shards, 1)
+    while os.path.exists(shard_path(shard)):
+        for suffix in ("", "-wal", "-shm"):
+            path = shard_path(shard) + suffix
+            if os.path.exists(path):
+                os.remove(path)
+        shard += 1
+
+
+def start_bulk():
+    """Start a full reindex into FINJA.tmp. The postings are appended to
+    plain tables and durability is off, a failed build is just deleted.
+    Searches use the old FINJA until finish_bulk swaps it"""
+    global _db_cache
+    global _hash_name
+    if _args.batch > 0:
+        raise ValueError("--bulk can't be combined with --batch")
+    # Keep the settings of the existing index
+    interpunct, hash_name, trigrams = index_settings()
+    check_hash(hash_name)
+    tmp_path = _db_path + ".tmp"
+    for path in (tmp_path, tmp_path + "-journal"):
+        if os.path.exists(path):
+            os.remove(path)
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('PRAGMA encoding = "UTF-8";')
+    # Bigger pages make the bulk load faster, but every page changed by an
+    # update has to be written
+    connection.execute('PRAGMA page_size = 16384;')
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    connection.execute('PRAGMA journal_mode = OFF;')
+    connection.execute('PRAGMA synchronous = OFF;')
+    connection.execute('PRAGMA cache_size = -%d;' % (_bulk_cache / 1024))
+    create_tables(
+        connection, interpunct, hash_name, _shards, trigrams, bulk=True
+    )
+    connection.commit()
+    _hash_name = hash_name  # noqa
+    token_dict = TokenDict(connection)
+    token_dict.count_refs = False
+    _db_cache = (  # noqa
+        connection,
+        token_dict,
+    )
+    return _db_cache
+
+
+def finish_bulk(db):
+    """Build the bulk database, then it replaces FINJA"""
+    build_bulk(db)
+    release_old(_db_path)
+    os.rename(_db_path + ".tmp", _db_path)
+
+
+def build_bulk(db):
+    """Sort the postings into their clustered tables, create the indexes
+    and count the token references"""
+    global _db_cache
+    con = db[0]
+    with _stats.timer("commit"):
+        con.execute("ALTER TABLE finja RENAME TO finja_bulk;")
+        con.execute(_create_postings)
+        con.execute(_sort_bulk_postings)
+        con.execute("DROP TABLE finja_bulk;")
+        con.execute("ALTER TABLE file_token RENAME TO file_token_bulk;")
+        con.execute(_create_file_tokens)
+        con.execute(_sort_bulk_file_tokens)
+        con.execute("DROP TABLE file_token_bulk;")
+        con.execute("ALTER TABLE trigram RENAME TO trigram_bulk;")
+        con.execute(_create_trigrams)
+        con.execute(_sort_bulk_trigrams)
+        con.execute("DROP TABLE trigram_bulk;")
+        con.execute(_create_postings_content_idx)
+        con.execute(_create_file_tokens_content_idx)
+        con.execute(_create_trigrams_content_idx)
+        con.execute(_create_token_id_idx)
+        for index in _create_file_indexes:
+            con.execute(index)
+        con.execute(_count_token_refs)
+        con.commit()
+    con.close()
+    _db_cache = None  # noqa
+
+
+def release_old(path):
+    """Checkpoint the database a bulk build replaces. New connections must
+    not find frames of the old database in its WAL, readers that have the
+    old database open keep it"""
+    if not os.path.exists(path):
+        return
+    old = sqlite3.connect(path)
+    res = old.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+    old.close()
+    if res and res[0][0]:
+        raise ValueError(
+            "%s is busy, the new index is in %s.tmp" % (path, path)
+        )
+
+
+def swap_bulk_shards():
+    """Replace the shards by their bulk builds once all of them are built.
+    FINJA, which holds the number of shards, is replaced last"""
+    shards = list(reversed(range(_shards)))
+    for shard in shards:
+        release_old(shard_path(shard))
+    for shard in shards:
+        os.rename(shard_path(shard) + ".tmp", shard_path(shard))
+
+
 def do_index(db, update=False):
-    # Reindexing duplicates that have changed is a two pass process
-    global _do_second_pass
+    global _trigrams
     con = db[0]
+    check_hash(_hash_name)
     if _args.clear_inodes:
-        con.execute(_clear_inodes)
+        con.execute(_clear_signatures)
     interpunct = get_key(DatabaseKey.INTERPUNCT, con)
     prepare_regex(interpunct)
-    _do_second_pass = False
-    do_index_pass(db, update)
-    if _do_second_pass:
-        if not update:
-            print("Second pass")
-        do_index_pass(db, True)
+    _trigrams = bool(get_key(DatabaseKey.TRIGRAMS, con))  # noqa
+    _stats.reset()
+    start_pool(interpunct)
+    try:
+        do_index_pass(db, update)
+    finally:
+        stop_pool()
+    _stats.stop()
+    if _args.stats_json:
+        _stats.write_json(_args.stats_json, db[1])
+
+
+def writer_step(con, size=0):
+    """Count a file handled by the writer and commit once the batch is
+    full"""
+    global _writer_files
+    global _writer_bytes
+    _writer_files += 1  # noqa
+    _writer_bytes += size  # noqa
+    if (
+            _writer_files >= _args.commit_files or
+            _writer_bytes >= _args.commit_bytes
+    ):
+        writer_commit(con)
+
+
+def writer_commit(con):
+    """Commit the batch, files and their index are always committed
+    together. Files pending in the pool aren't checked yet, they have no
+    state in the database"""
+    global _writer_files
+    global _writer_bytes
+    with _stats.timer("commit"):
+        con.commit()
+    _writer_files = 0  # noqa
+    _writer_bytes = 0  # noqa
+
+
+def init_worker(interpunct, trigrams):
+    global _trigrams
+    prepare_regex(interpunct)
+    _trigrams = trigrams  # noqa
+
+
+def start_pool(interpunct):
+    """Start the tokenizer processes, the calling process stays the only
+    writer"""
+    global _pool
+    if _args.jobs > 1:
+        import multiprocessing
+        _pool = multiprocessing.Pool(  # noqa
+            _args.jobs,
+            initializer=init_worker,
+            initargs=(interpunct, _trigrams)
+        )
 
 
-def is_dotfile(path):
-    """
-    Return true if any path component of the given path starts with a dot.
+def stop_pool():
+    global _pool
+    global _pending
+    if _pool:
+        _pool.terminate()
+        _pool.join()
+        _pool = None  # noqa
+    _pending = []  # noqa
 
-    Note that single-dot paths ("./") do not count as such.
 
-    >>> is_dotfile('./foo/bar/baz')
+def flush_pending(db, update=False):
+    """Tokenize the pending files in the pool and write the results in
+    order"""
+    con     = db[0]
+    results = _pool.imap(
+        ingest_file,
+        [(x[1], x[3], _hash_name) for x in _pending]
+    )
+    for hashsum, result, times in results:
+        _stats.merge(times)
+        file_, file_path, signature, old_hash = _pending.pop(0)
+        if file_ is None:
+            # The same path might have been queued twice
+            file_ = _file_state.get(file_path, (None,))[0]
+        do_index, file_, content_ = check_file(
+            con, file_, file_path, signature, old_hash, hashsum, update
+        )
+        _seen_files.add(file_)
+        if do_index:
+            encoding = write_index(db, content_, file_path, result, update)
+            con.execute(_update_content_info, (encoding, content_))
+
+
+def load_file_state(con):
+    """Load path -> (id, signature, hash, found, content id) of all files"""
+    global _file_state
+    global _seen_files
+    global _released_content
+    _file_state = {}  # noqa
+    _seen_files = set()  # noqa
+    _released_content = set()  # noqa
+    for path, file_, signature, hashsum, found, content_ in con.execute(
+            _load_file_state
+    ):
+        _file_state[path] = (file_, signature, hashsum, found, content_)
+
+
+def sweep_missing_files(con):
+    """Diff the file state against the files seen in this pass: only the
+    missing files are deleted, by primary key. Their content is released"""
+    missing = []
+    for file_, _, _, _, content_ in six.itervalues(_file_state):
+        if file_ not in _seen_files:
+            missing.append((file_,))
+            if content_:
+                _released_content.add(content_)
+    con.executemany(_delete_file, missing)
+
+
+def delete_content(db, contents):
+    """Delete content entries and their index, tokens that aren't
+    referenced anymore are deleted"""
+    con  = db[0]
+    refs  = collections.Counter()
+    files = collections.Counter()
+    for content_ in contents:
+        for token_id, count in con.execute(_content_token_refs, (content_,)):
+            refs[token_id]  += count
+            files[token_id] += 1
+    db[1].release(refs, files)
+    contents = [(x,) for x in contents]
+    con.executemany(_delete_content_index, contents)
+    con.executemany(_delete_content_file_tokens, contents)
+    con.executemany(_delete_content_trigrams, contents)
+    con.executemany(_delete_content, contents)
+
+
+def delete_released_content(db):
+    """Delete the content no file points to anymore. Only the content that
+    files pointed to before this pass is checked"""
+    con      = db[0]
+    orphaned = []
+    for content_ in _released_content:
+        res = con.execute(_content_in_use, (content_,)).fetchall()
+        if res[0][0] == 0:
+            orphaned.append(content_)
+    delete_content(db, orphaned)
+    _released_content.clear()
+
+
+def vacuum(db):
+    """Delete orphaned content and return free pages to the filesystem. With
+    incremental auto_vacuum free pages are released in steps until the time
+    budget is used, other databases are converted by a full VACUUM"""
+    con = db[0]
+    con.set_progress_handler(progress, 100000)
+    with con:
+        delete_content(
+            db, [x[0] for x in con.execute(_find_orphaned_content)]
+        )
+    ilevel = con.isolation_level
+    con.isolation_level = None
+    try:
+        mode = con.execute("PRAGMA auto_vacuum;").fetchall()[0][0]
+        if mode == 2:
+            deadline = _timer() + _args.vacuum_seconds
+            while _timer() < deadline:
+                con.execute(
+                    "PRAGMA incremental_vacuum(%d);" % _vacuum_pages
+                ).fetchall()
+                free = con.execute("PRAGMA freelist_count;").fetchall()
+                if not free[0][0]:
+                    break
+        else:
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            con.execute("VACUUM;")
+        # The file shrinks when the WAL is checkpointed
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+    finally:
+        con.isolation_level = ilevel
+        con.set_progress_handler(None, 100000)
+
+
+def has_ignored_ext(filename):
+    ext  = None
+    ext2 = None
+    if '.' in filename:
+        split = filename.split(os.path.extsep)
+        ext = split[-1].lower()
+        if len(split) > 2:
+            ext2 = split[-2].lower()
+            if len(ext2) > 4:
+                ext2 = None
+    return ext in _ignore_ext or ext2 in _ignore_ext
+
+
+class IgnoreRules(object):
+    """Ignore rules in the style of .gitignore, relative to the index root.
+
+    >>> rules = IgnoreRules(["node_modules/", "/build", "*.min.js", "!a.*"])
+    >>> rules.ignored("web/node_modules", True)
+    True
+    >>> rules.ignored("web/build", True)
     False
-    >>> is_dotfile('./foo/.bar/baz')
+    >>> rules.ignored("build", True)
     True
-
+    >>> rules.ignored("web/x.min.js", False)
+    True
+    >>> rules.ignored("web/a.min.js", False)
+    False
     """
-    return any([
-        p.startswith('.')
-        for p
-        in path.split(os.sep)
-        if p not in ('..', '.')
-    ])
+
+    def __init__(self, lines=()):
+        self.rules = []
+        for line in lines:
+            self.add(line)
+
+    def add(self, line):
+        line = line.rstrip("\r\n")
+        if not line.endswith("\\ "):
+            line = line.rstrip(" ")
+        if not line or line.startswith("#"):
+            return
+        negate = False
+        if line.startswith("!"):
+            negate = True
+            line   = line[1:]
+        elif line.startswith("\\"):
+            line   = line[1:]
+        dir_only = line.endswith("/")
+        line     = line.rstrip("/")
+        # Patterns containing a slash are anchored to the root
+        anchored = "/" in line
+        line     = line.lstrip("/")
+        if line:
+            self.rules.append((
+                re.compile(self.translate(line)),
+                negate,
+                dir_only,
+                anchored
+            ))
+
+    @staticmethod
+    def translate(pattern):
+        """Translate a pattern to a regex, "*" doesn't match "/" but "**"
+        does"""
+        res = []
+        pos = 0
+        end = len(pattern)
+        while pos < end:
+            char = pattern[pos]
+            if pattern.startswith("**/", pos):
+                res.append("(?:.*/)?")
+                pos += 3
+                continue
+            elif pattern.startswith("**", pos):
+                res.append(".*")
+                pos += 2
+                continue
+            elif char == "*":
+                res.append("[^/]*")
+            elif char == "?":
+                res.append("[^/]")
+            elif char == "[":
+                close = pattern.find("]", pos + 2)
+                if close < 0:
+                    res.append("\\[")
+                else:
+                    group = pattern[pos + 1:close].replace("\\", "\\\\")
+                    if group.startswith("!"):
+                        group = "^" + group[1:]
+                    res.append("[%s]" % group)
+                    pos = close
+            else:
+                res.append(re.escape(char))
+            pos += 1
+        return "".join(res) + "\\Z"
+
+    def ignored(self, path, is_dir):
+        """Return true if path is ignored, the last matching rule wins"""
+        name   = path.rsplit("/", 1)[-1]
+        result = False
+        for regex, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path if anchored else name):
+                result = not negate
+        return result
+
+
+def load_ignore_rules():
+    """Rules from FINJA.ignore and --exclude"""
+    rules = IgnoreRules()
+    if os.path.exists("FINJA.ignore"):
+        with codecs.open("FINJA.ignore", "r", encoding="UTF-8") as f:
+            for line in f.readlines():
+                rules.add(line)
+    for line in _args.exclude or []:
+        rules.add(line)
+    return rules
+
+
+def walk_files(rules):
+    """Yield (path, stat_result) of the files to index.
+
+    Hidden and ignored directories are pruned before descending into them
+    and the stat of the directory entry is reused. stat_result is None if
+    stat failed, (bad symlinks etc.)."""
+    stack = [""]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(scandir(dirpath or "."))
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            if name.startswith("."):
+                # Skip "hidden" files and dirs
+                continue
+            if dirpath:
+                path = "/".join((dirpath, name))
+            else:
+                path = name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Like os.walk we don't follow symlinks to directories
+                if (
+                        entry.is_symlink() or
+                        name in _ignore_dir or
+                        rules.ignored(path, True)
+                ):
+                    continue
+                subdirs.append(path)
+            else:
+                if (
+                        name in _index_files or
+                        name.startswith("FINJA.shard") or
+                        has_ignored_ext(name) or
+                        rules.ignored(path, False) or
+                        path_shard(path) != _shard
+                ):
+                    continue
+                try:
+                    with _stats.timer("stat"):
+                        stat_res = entry.stat()
+                except OSError:
+                    stat_res = None
+                if os.sep != "/":  # pragma: no cover
+                    path = path.replace("/", os.sep)
+                yield path, stat_res
+        # Depth first in directory order, like os.walk
+        stack.extend(reversed(subdirs))
 
 
 def do_index_pass(db, update=False):
-    global _do_second_pass
     con = db[0]
-    if not _args.batch > 0:
-        with con:
-            con.execute(_clear_found_files)
+    load_file_state(con)
     if os.path.exists("FINJA.lst"):
         with codecs.open("FINJA.lst", "r", encoding="UTF-8") as f:
             for path in f.readlines():
                 file_path = os.path.relpath(path.strip())
-                index_file(db, file_path, update)
-    else:
-        for dirpath, _, filenames in os.walk("."):
-            if is_dotfile(dirpath):
-                # Skip "hidden" dirs
-                continue
-
-            if set(dirpath.split(os.sep)).intersection(_ignore_dir):
-                continue
-            for filename in filenames:
-                if is_dotfile(filename) or filename in ('FINJA', 'FINJA.lst'):
-                    # Skip "hidden" and index files
-                    continue
-                ext  = None
-                ext2 = None
-                if '.' in filename:
-                    split = filename.split(os.path.extsep)
-                    ext = split[-1].lower()
-                    if len(split) > 2:
-                        ext2 = split[-2].lower()
-                        if len(ext2) > 4:
-                            ext2 = None
-                if ext not in _ignore_ext and ext2 not in _ignore_ext:
-                    file_path = os.path.relpath(os.path.join(
-                        dirpath,
-                        filename
-                    ))
+                if path_shard(file_path) == _shard:
                     index_file(db, file_path, update)
-    with con:
-        res = con.execute(_find_missing_files).fetchall()
-        if res[0][0] > 0:
-            con.execute(_delete_missing_indexes)
-            con.execute(_delete_missing_files)
-            _do_second_pass = True  # noqa
+    else:
+        rules = load_ignore_rules()
+        for file_path, stat_res in _stats.timed_walk(walk_files(rules)):
+            index_file(db, file_path, update, stat_res)
+    if _pending:
+        flush_pending(db, update)
+    # The sweep is committed with the last batch
+    if not _args.batch > 0:
+        sweep_missing_files(con)
+    delete_released_content(db)
+    writer_commit(con)
 
 # Indexer
 
 
-def index_file(db, file_path, update = False):
-    global _index_count
+def index_file(db, file_path, update = False, stat_res = None):
     if six.PY2:
         if not isinstance(file_path, unicode):  # noqa
             file_path = unicode(file_path, encoding="UTF-8")  # noqa
     con        = db[0]
     # Bad symlinks etc.
     try:
-        stat_res = os.stat(file_path)
+        if stat_res is None:
+            with _stats.timer("stat"):
+                stat_res = os.stat(file_path)
     except OSError:
-        if not update:
+        if not (update or _args.quiet):
             print("%s: not found, skipping" % (file_path,))
         return
     if not stat.S_ISREG(stat_res[stat.ST_MODE]):
-        if not update:
+        if not (update or _args.quiet):
             print("%s: not a plain file, skipping" % (file_path,))
-        return
-    inode_mod     = (stat_res[stat.ST_INO] * stat_res[stat.ST_MTIME]) % 2 ** 62
-    old_inode_mod = None
-    old_md5       = None
-    file_         = None
-    with con:
-        res = con.execute(_find_file, (file_path,)).fetchall()
-        if res:
-            file_         = res[0][0]
-            old_inode_mod = res[0][1]
-            old_md5       = res[0][2]
-    if old_inode_mod != inode_mod:
-        do_index, file_ = check_file(
-            con, file_, file_path, inode_mod, old_md5, update
-        )
-        if not do_index:
-            return
-        encoding = read_index(db, file_, file_path, update)
-        con.execute(_update_file_info, (encoding, file_path))
+        return
+    signature     = file_signature(stat_res)
+    old_signature = None
+    old_hash      = None
+    file_         = None
+    found         = 1
+    state         = _file_state.get(file_path)
+    if state:
+        file_, old_signature, old_hash, found, _ = state
+    _stats.seen()
+    if old_signature != signature:
+        _stats.read(stat_res[stat.ST_SIZE])
+        if _pool:
+            # The worker reads the file, so it is checked when the result
+            # arrives
+            _pending.append((file_, file_path, signature, old_hash))
+            if len(_pending) >= _args.jobs * _pool_chunk:
+                flush_pending(db, update)
+        else:
+            data = load_file(file_path)
+            do_index, file_, content_ = check_file(
+                con,
+                file_,
+                file_path,
+                signature,
+                old_hash,
+                content_hash(data),
+                update
+            )
+            _seen_files.add(file_)
+            if do_index:
+                encoding = write_index(
+                    db, content_, file_path, read_file(file_path, data), update
+                )
+                con.execute(_update_content_info, (encoding, content_))
+        writer_step(con, stat_res[stat.ST_SIZE])
     else:
-        if not update:
+        if not (update or _args.quiet):
             print("%s: uptodate" % (file_path,))
-        with con:
+        _seen_files.add(file_)
+        if not found:
             con.execute(_mark_found, (file_path,))
+            writer_step(con)
 
 
-def check_file(con, file_, file_path, inode_mod, old_md5, update=False):
-    global _do_second_pass
-    md5sum = md5(file_path)
-    with con:
-        # We assume duplicated
-        duplicated = True
-        if old_md5:
-            res = con.execute(_check_for_duplicates, (old_md5,)).fetchall()
-            had_duplicates = res[0][0] > 1
-            if had_duplicates and old_md5 != md5sum:
-                _do_second_pass = True  # noqa
-                con.execute(_clear_inode_md5_of_duplicates, (old_md5,))
-                # We know for sure not duplicated
-                duplicated = False
-        # This was the assumption, we have to check
-        if duplicated:
-            res = con.execute(_check_for_duplicates, (md5sum,)).fetchall()
-            duplicated = res[0][0] > 0
-        if file_ is None:
-            cur = con.cursor()
-            cur.execute(
-                _create_new_file_entry, (file_path, md5sum, inode_mod)
-            )
-            file_ = cur.lastrowid
-        else:
-            con.execute(_update_file_entry, (md5sum, inode_mod, file_))
-        if duplicated:
-            if not update:
-                if md5sum == old_md5:
-                    print("%s: not changed, skipping" % (file_path,))
-                else:
-                    print("%s: duplicated, skipping" % (file_path,))
-            return (False, file_)
-    return (old_md5 != md5sum, file_)
+def check_file(
+        con, file_, file_path, signature, old_hash, hashsum, update=False
+):
+    """Point the file to the content with its hash. Content that is already
+    known (unchanged or duplicated) isn't indexed again.
+
+    Returns (content is new, file id, content id)"""
+    res = con.execute(_find_content, (hashsum,)).fetchall()
+    new = not res
+    if new:
+        cur = con.cursor()
+        cur.execute(_create_content, (hashsum,))
+        content_ = cur.lastrowid
+    else:
+        content_ = res[0][0]
+    old_content = None
+    if file_ is None:
+        cur = con.cursor()
+        cur.execute(
+            _create_new_file_entry, (file_path, content_, signature)
+        )
+        file_ = cur.lastrowid
+    else:
+        old_content = _file_state[file_path][4]
+        con.execute(_update_file_entry, (content_, signature, file_))
+    if old_content and old_content != content_:
+        _released_content.add(old_content)
+    _file_state[file_path] = (file_, signature, hashsum, 1, content_)
+    if not new:
+        if not (update or _args.quiet):
+            if hashsum == old_hash:
+                print("%s: not changed, skipping" % (file_path,))
+            else:
+                print("%s: duplicated, skipping" % (file_path,))
+    return (new, file_, content_)
 
 
-def read_index(db, file_, file_path, update = False):
+def ingest_file(args):
+    """Read, hash and tokenize a file in a worker process. If the content
+    didn't change it isn't tokenized.
+
+    Returns (hash, result of read_file or None, phase times)"""
+    file_path, old_hash, hash_name = args
+    _stats.reset()
+    data    = load_file(file_path)
+    hashsum = content_hash(data, hash_name)
+    if hashsum == old_hash:
+        return (hashsum, None, _stats.times)
+    return (hashsum, read_file(file_path, data), _stats.times)
+
+
+def read_file(file_path, data):
+    """Tokenize the data of a file, this doesn't touch the database, so it
+    can run in a worker process.
+
+    Returns (state, encoding, postings, insert_count, grams), where
+    postings is a set of (token string, line) pairs and grams the set of
+    trigrams, if the trigrams are indexed."""
+    encoding     = "UTF-8"
+    postings     = set()
+    grams        = set()
+    if is_binary_data(file_path, data):
+        return ("binary", encoding, postings, 0, grams)
+    try:
+        insert_count = parse_data(data, postings, grams, encoding)
+    except UnicodeDecodeError:
+        try:
+            encoding = detect_encoding(data)
+            if not encoding:
+                return ("failed", "UTF-8", set(), 0, set())
+            postings     = set()
+            insert_count = parse_data(data, postings, grams, encoding)
+        except UnicodeDecodeError:
+            return ("failed", encoding, set(), 0, set())
+    return ("ok", encoding, postings, insert_count, grams)
+
+
+def write_index(db, content_, file_path, result, update = False):
     global _index_count
     con          = db[0]
     token_dict   = db[1]
-    encoding     = "UTF-8"
-    if is_binary(file_path):
-        if not update:
+    state, encoding, postings, insert_count, grams = result
+    if state == "binary":
+        if not (update or _args.quiet):
             print("%s: is binary, skipping" % (file_path,))
     else:
         if _args.batch > 0:
             _index_count += 1  # noqa
             if _index_count > _args.batch:
+                reset_unwritten(con, content_)
                 con.close()
                 sys.exit(0)
-        try:
-            inserts      = set()
-            insert_count = parse_file(db, file_, file_path, inserts, encoding)
-        except UnicodeDecodeError as e:
-            try:
-                with open(file_path, "rb") as f:
-                    detector = UniversalDetector()
-                    for line in f.readlines():
-                        detector.feed(line)
-                        if detector.done:
-                            break
-                    detector.close()
-                    encoding = detector.result['encoding']
-                if not encoding:
-                    raise e
-                inserts      = set()
-                insert_count = parse_file(
-                    db, file_, file_path, inserts, encoding
-                )
-            except UnicodeDecodeError:
+        if state == "failed":
+            if not _args.quiet:
                 print("%s: decoding failed %s" % (
                     file_path,
                     encoding
                 ))
-                inserts.clear()
-                return encoding
-        tokens = set([x[0] for x in inserts])
-        for token in tokens:
-            inserts.add((token, file_, -1))
-        with con:
+            return encoding
+        # Resolve in a stable order, so the token ids don't depend on the
+        # process that tokenized the file
+        tokens = sorted(set([x[0] for x in postings]))
+        with _stats.timer("resolve"):
+            ids = token_dict.resolve(tokens)
+            inserts = set([
+                (ids[token], content_, line) for token, line in postings
+            ])
+            file_tokens = set([(ids[token], content_) for token in tokens])
+        with _stats.timer("insert"):
             new = token_dict.commit()
-            con.execute(_clear_existing_index, (file_,))
             con.executemany(_insert_index, inserts)
+            con.executemany(_insert_file_token, file_tokens)
+            con.executemany(_insert_trigram, [(x, content_) for x in grams])
+            token_dict.reference(
+                collections.Counter([x[0] for x in inserts])
+            )
         unique_inserts = len(inserts)
-        print("%s: indexed %s/%s (%.3f) new: %s %s" % (
-            file_path,
-            unique_inserts,
-            insert_count,
-            float(unique_inserts) / (insert_count + 0.0000000001),
-            new,
-            encoding
-        ))
-        clear_cache(db)
+        _stats.indexed(unique_inserts, new)
+        if not _args.quiet:
+            print("%s: indexed %s/%s (%.3f) new: %s %s" % (
+                file_path,
+                unique_inserts,
+                insert_count,
+                float(unique_inserts) / (insert_count + 0.0000000001),
+                new,
+                encoding
+            ))
     return encoding
 
 
-def regex_parser_postive(f, file_, regex, db, inserts, insert_count):
-    token_dict   = db[1]
-    lineno = 1
-    for line in f.readlines():
+def reset_unwritten(con, content_):
+    """Content that was created but not written must be checked again"""
+    with con:
+        con.execute(_reset_unwritten_files, (content_,))
+        con.execute(_delete_content, (content_,))
+
+
+def tokenize_line(line):
+    """Yield the raw tokens of all tokenization strategies for a line"""
+    for regex in _positive_regex:
         for match in regex.finditer(line):
-            word = cleanup(match.group(0))
-            if word:
-                insert_count += 1
-                inserts.add((
-                    token_dict[word],
-                    file_,
-                    lineno,
-                ))
-        lineno += 1
-    return insert_count
+            yield match.group(0)
+    for regex in _split_regex:
+        for token in regex.split(line):
+            yield token
 
 
-def regex_parser_split(f, file_, regex, db, inserts, insert_count):
-    token_dict   = db[1]
+def parse_text(text, postings):
+    """Add the (token string, line) pairs of text to postings and return the
+    count of tokens before removing duplicates"""
+    insert_count = 0
     lineno = 1
-    for line in f.readlines():
-        tokens = re.split(regex, line)
-        for token in tokens:
+    # Same line splitting as readlines() of a codecs reader
+    for line in text.splitlines(True):
+        raw_tokens = {}
+        for token in tokenize_line(line):
+            raw_tokens[token] = raw_tokens.get(token, 0) + 1
+        words = set()
+        for token, count in six.iteritems(raw_tokens):
             word = cleanup(token)
             if word:
-                insert_count += 1
-                inserts.add((
-                    token_dict[word],
-                    file_,
-                    lineno,
-                ))
+                insert_count += count
+                words.add(word)
+        for word in words:
+            postings.add((word, lineno))
         lineno += 1
     return insert_count
 
 
-def parse_file(db, file_, file_path, inserts, encoding="UTF-8"):
-    insert_count = 0
-    with codecs.open(file_path, "r", encoding=encoding) as f:
-        for positive_match in _positive_regex:
-            insert_count = regex_parser_postive(
-                f, file_, positive_match, db, inserts, insert_count
-            )
-            f.seek(0)
-        for split in _split_regex:
-            insert_count = regex_parser_split(
-                f, file_, split, db, inserts, insert_count
-            )
-            f.seek(0)
+def parse_data(data, postings, grams, encoding="UTF-8"):
+    if six.PY2 and not isinstance(data, bytes):  # pragma: no cover
+        # mmap
+        data = data[:]
+    with _stats.timer("tokenize"):
+        text = codecs.decode(data, encoding)
+        insert_count = parse_text(text, postings)
+    if _trigrams:
+        with _stats.timer("trigrams"):
+            grams.update(trigrams(text))
     return insert_count
 
+# Search
 
-def clear_cache(db):
-    # clear cache
-    db = list(db)[1:]
-    size = 0
-    for cache_dict in db:
-        size += len(cache_dict)
-    if size > _cache_size:
-        print("Clear cache")
-        for cache_dict in db:
-            cache_dict.clear()
 
-# Search
+def intersect_shard(con, token_ids, pignore, file_mode):
+    """Intersect the postings of the tokens in Python, starting with the
+    rarest token. The other tokens are only looked up in the content of
+    the matches so far"""
+    if file_mode:
+        query = _token_contents
+    else:
+        query = _token_postings
+    matches = set(con.execute(query.format(contents=""), (token_ids[0],)))
+    for token_id in token_ids[1:]:
+        ids   = sorted(set([x[0] for x in matches]))
+        found = set()
+        for pos in range(0, len(ids), _sql_chunk):
+            chunk = ids[pos:pos + _sql_chunk]
+            found.update(con.execute(query.format(
+                contents="AND content_id IN (%s)" % (
+                    ", ".join(["?"] * len(chunk))
+                )
+            ), [token_id] + chunk))
+        matches &= found
+        if not matches:
+            return []
+    ids    = sorted(set([x[0] for x in matches]))
+    ignore = "\n".join(["AND f.path NOT LIKE ?"] * len(pignore))
+    files  = {}
+    for pos in range(0, len(ids), _sql_chunk):
+        chunk = ids[pos:pos + _sql_chunk]
+        query = _content_files.format(
+            contents="c.id IN (%s)" % ", ".join(["?"] * len(chunk)),
+            ignore=ignore,
+        )
+        for path, file_, content_, encoding in con.execute(
+                query, chunk + pignore
+        ):
+            files[content_] = (path, file_, encoding)
+    if file_mode:
+        return [files[x][:2] for x in ids if x in files]
+    res = []
+    for content_, line in matches:
+        if content_ in files:
+            path, file_, encoding = files[content_]
+            res.append((path, file_, line, encoding))
+    return res
 
 
-def search_term_cardinality(term_id):
-    db         = get_db(create = False)
-    con        = db[0]
+def grep_mode():
+    """--substring or --regex search"""
+    args = current_args()
+    return args.substring or args.regex
+
+
+def grep_regex(term):
+    """The regex of a --substring or --regex search string"""
+    if current_args().regex:
+        return term
+    return re.escape(term)
+
+
+def regex_chars(items, ignore_case=False):
+    """Yield the literal characters every match of a parsed regex contains,
+    None separates characters that aren't adjacent in a match"""
+    for op, arg in items:
+        if op == sre_constants.LITERAL and not ignore_case:
+            yield six.unichr(arg)
+        elif op == sre_constants.AT:
+            # Anchors don't match characters
+            continue
+        elif op == sre_constants.SUBPATTERN:
+            group_case = ignore_case
+            if len(arg) == 4:
+                # Python 3 has (group, add_flags, del_flags, pattern)
+                if arg[1] & re.I:
+                    group_case = True
+                elif arg[2] & re.I:
+                    group_case = False
+            for char in regex_chars(arg[-1], group_case):
+                yield char
+        elif (
+                op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+                and arg[0] > 0
+        ):
+            # The first repetition follows the characters before, the last
+            # one is followed by the characters after
+            for char in regex_chars(arg[2], ignore_case):
+                yield char
+            yield None
+            for char in regex_chars(arg[2], ignore_case):
+                yield char
+        else:
+            yield None
+
+
+def required_trigrams(term):
+    """The trigrams of the literals every match of a search string
+    contains"""
+    if current_args().regex:
+        parsed = sre_parse.parse(term)
+        state  = getattr(parsed, "state", None) or parsed.pattern
+        chars  = regex_chars(parsed, state.flags & re.I)
+    else:
+        chars  = term
+    grams   = set()
+    literal = ""
+    for char in chars:
+        if char is None:
+            grams.update(trigrams(literal))
+            literal = ""
+        else:
+            literal += char
+    grams.update(trigrams(literal))
+    return grams
 
-    curs = con.cursor()
-    res = curs.execute(_token_cardinality, [term_id]).fetchall()
-    return res[0][0]
 
+def trigram_candidates(con, grams):
+    """Intersect the content of the trigrams, starting with the rarest
+    trigram.
 
-def order_search_terms(search):
-    res = sorted(search, key=search_term_cardinality)
+    Returns the ids of the content containing all trigrams"""
+    counts = sorted([
+        (con.execute(_trigram_cardinality, (x,)).fetchall()[0][0], x)
+        for x in grams
+    ])
+    candidates = None
+    for _, gram in counts:
+        if candidates is None:
+            query = _trigram_contents.format(contents="")
+            candidates = set([x[0] for x in con.execute(query, (gram,))])
+        else:
+            ids = sorted(candidates)
+            candidates = set()
+            for pos in range(0, len(ids), _sql_chunk):
+                chunk = ids[pos:pos + _sql_chunk]
+                query = _trigram_contents.format(
+                    contents="AND content_id IN (%s)" % (
+                        ", ".join(["?"] * len(chunk))
+                    )
+                )
+                candidates.update([
+                    x[0] for x in con.execute(query, [gram] + chunk)
+                ])
+        if not candidates:
+            break
+    return candidates
+
+
+def grep_shard(con, terms, pignore, file_mode):
+    """Substring and regex search on one shard. The content containing the
+    trigrams of all search strings is read and matched line by line,
+    without trigram index all text content is read"""
+    regexes = [re.compile(grep_regex(x)) for x in terms]
+    grams   = set()
+    if get_key(DatabaseKey.TRIGRAMS, con):
+        for term in terms:
+            grams.update(required_trigrams(term))
+    if grams:
+        ids    = sorted(trigram_candidates(con, grams))
+        chunks = [
+            ids[pos:pos + _sql_chunk] for pos in range(0, len(ids), _sql_chunk)
+        ]
+    else:
+        chunks = [[]]
+    ignore = "\n".join(["AND f.path NOT LIKE ?"] * len(pignore))
+    files  = []
+    for chunk in chunks:
+        if chunk:
+            contents = "c.id IN (%s)" % ", ".join(["?"] * len(chunk))
+        else:
+            contents = _grep_all_content
+        query = _content_files.format(contents=contents, ignore=ignore)
+        files.extend(con.execute(query, chunk + pignore).fetchall())
+    res = []
+    for path, file_, _, encoding in files:
+        try:
+            with codecs.open(path, "r", encoding=encoding or "UTF-8") as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError, UnicodeDecodeError):
+            continue
+        if file_mode:
+            if all(any(x.search(y) for y in lines) for x in regexes):
+                res.append((path, file_))
+            continue
+        for lineno, line in enumerate(lines, 1):
+            if all(x.search(line) for x in regexes):
+                res.append((path, file_, lineno, encoding))
     return res
 
 
+def search_shard(con, terms, pignore, file_mode, limit=0):
+    """Run the search on one shard. If a term isn't in the shard nothing
+    can match. Patterns are expanded by the query, after the exact terms.
+
+    Returns an iterator over the matches ordered by path and line"""
+    if grep_mode():
+        return iter(sorted(grep_shard(con, terms, pignore, file_mode)))
+    search_tokens = []
+    patterns      = []
+    for term in terms:
+        if is_pattern(term):
+            patterns.append(term)
+            continue
+        res = con.execute(
+            _token_stats, (sql_token(token_key(term or "")),)
+        ).fetchall()
+        if not res:
+            return iter([])
+        token_id, refs, files = res[0]
+        # The rarest term drives the join
+        if file_mode:
+            search_tokens.append((files, token_id))
+        else:
+            search_tokens.append((refs, token_id))
+    search_tokens.sort()
+    token_ids = [x[1] for x in search_tokens]
+    if (
+            len(token_ids) > 1 and
+            not patterns and
+            search_tokens[0][0] <= _intersect_limit
+    ):
+        return iter(sorted(
+            intersect_shard(con, token_ids, pignore, file_mode)
+        ))
+    query = gen_search_query(
+        pignore,
+        file_mode,
+        [False] * len(token_ids) + [True] * len(patterns),
+        limit > 0,
+    )
+    args = []
+    args.extend(token_ids)
+    for pattern in patterns:
+        args.extend(pattern_args(pattern))
+    args.extend(pignore)
+    if limit > 0:
+        args.append(limit)
+    return con.execute(query, args)
+
+
+def search_shard_thread(
+        con, request, terms, pignore, file_mode, limit, queue, stop
+):
+    """Search a shard with its own connection. The matches are put into the
+    queue in chunks, None ends the stream"""
+    enter_request(request)
+    try:
+        res = search_shard(con, terms, pignore, file_mode, limit)
+        while not stop.is_set():
+            chunk = list(itertools.islice(res, _sql_chunk))
+            if not chunk:
+                break
+            put_chunk(queue, stop, chunk)
+    except Exception as e:
+        put_chunk(queue, stop, e)
+    finally:
+        if not _serving:
+            con.close()
+    put_chunk(queue, stop, None)
+
+
+def search_con(shard):
+    """Connection of a search thread to a shard, the daemon keeps them
+    open between queries"""
+    handle = request_state("handle")
+    if handle is None:
+        return open_db(shard_path(shard), threads=True)
+    con = handle.search_cons.get(shard)
+    if con is None:
+        con = open_db(shard_path(shard), threads=True)
+        handle.search_cons[shard] = con
+    return con
+
+
+def put_chunk(queue, stop, chunk):
+    """Wait for space in the queue until the search is stopped"""
+    from six.moves.queue import Full
+    while not stop.is_set():
+        try:
+            queue.put(chunk, timeout=0.1)
+            return
+        except Full:
+            pass
+
+
+def read_shard(queue):
+    """Matches a shard thread puts into the queue"""
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        for match in chunk:
+            yield match
+
+
+def search_shards(terms, pignore, file_mode, limit):
+    """Search the shards in parallel, SQLite releases the GIL while it runs a
+    query. The ordered matches of the shards are merged as they arrive"""
+    import threading
+    from six.moves.queue import Queue
+    stop    = threading.Event()
+    request = request_context()
+    queues  = []
+    threads = []
+    for shard in range(_shards):
+        queue  = Queue(4)
+        thread = threading.Thread(
+            target=search_shard_thread,
+            args=(
+                search_con(shard),
+                request,
+                terms,
+                pignore,
+                file_mode,
+                limit,
+                queue,
+                stop,
+            ),
+        )
+        thread.daemon = True
+        thread.start()
+        queues.append(queue)
+        threads.append(thread)
+    try:
+        for match in heapq.merge(*[read_shard(x) for x in queues]):
+            yield match
+    finally:
+        stop.set()
+        if _serving:
+            # The next search uses the same connections
+            for thread in threads:
+                thread.join()
+
+
+def limit_matches(res, file_mode):
+    """Stop after --limit matches and skip the lines of a file after
+    --max-per-file matches"""
+    args     = current_args()
+    limit    = args.limit
+    per_file = 0 if file_mode else args.max_per_file
+    if limit <= 0 and per_file <= 0:
+        for match in res:
+            yield match
+        return
+    count = 0
+    path  = None
+    for match in res:
+        if per_file > 0:
+            # File ids are per shard, the path identifies the file
+            if match[0] != path:
+                path    = match[0]
+                in_file = 0
+            in_file += 1
+            if in_file > per_file:
+                continue
+        yield match
+        count += 1
+        if count == limit:
+            return
+
+
+def stop_progress(con, res):
+    """Remove the progress display when the first match arrives"""
+    started = False
+    for match in res:
+        if not started:
+            started = True
+            con.set_progress_handler(None, 1000000)
+            if not current_args().raw:
+                sys.stdout.write("\b\b\b\b\b\b\b\b")
+        yield match
+    if not started:
+        con.set_progress_handler(None, 1000000)
+        if not current_args().raw:
+            sys.stdout.write("\b\b\b\b\b\b\b\b")
+
+
 def search(
         search,
         pignore,
@@ -1010,80 +3412,102 @@ def search(
     os.chdir(finja)
     db              = get_db(create = False)
     con             = db[0]
-    token_dict      = db[1]
     if update:
-        do_index(db, update=True)
-    if _args.vacuum:
-        con.set_progress_handler(progress, 100000)
-        con.execute(_delete_free_tokens)
-        ilevel = con.isolation_level
-        con.isolation_level = None
-        con.execute("VACUUM;")
-        con.isolation_level = ilevel
-        con.set_progress_handler(None, 100000)
+        if _shards > 1:
+            index_shards(update=True)
+            db  = get_db()
+            con = db[0]
+        else:
+            do_index(db, update=True)
+    if current_args().vacuum:
+        for shard in range(_shards):
+            if shard == 0:
+                vacuum(db)
+            else:
+                shard_db = shard_con(db, shard)
+                vacuum((shard_db, TokenDict(shard_db)))
     if not search:
         return
-    res = []
-    with con:
-        pignore = ["%{}%".format(x) for x in pignore]
-        query = gen_search_query(pignore, file_mode, len(search))
-        search_tokens = order_search_terms([
-            token_dict[cleanup(x)] for x in search
-        ])
-        args = []
-        args.extend(search_tokens)
-        args.extend(pignore)
-        con.set_progress_handler(progress, 1000000)
-        res = con.execute(query, args).fetchall()
-        con.set_progress_handler(None, 1000000)
-        if not _args.raw:
-            sys.stdout.write("\b\b\b\b\b\b\b\b")
-    if file_mode:
-        for match in sorted(
-                res,
-                key=lambda x: x[0],
-        ):
-            print(os.path.relpath(match[0], _cwd))
-            if not _args.raw:
-                display_duplicates(db, match[1])
+    pignore = ["%{}%".format(x) for x in pignore]
+    if grep_mode():
+        terms = list(search)
+    else:
+        terms = [cleanup(x) for x in search]
+    # With --max-per-file the query can't know how many matches are used
+    args  = current_args()
+    limit = 0 if args.max_per_file > 0 and not file_mode else args.limit
+    if _shards > 1:
+        format_result(
+            db,
+            limit_matches(
+                search_shards(terms, pignore, file_mode, limit),
+                file_mode
+            ),
+            search,
+            file_mode,
+        )
     else:
-        sort_format_result(db, res, search)
+        with con:
+            con.set_progress_handler(progress, 1000000)
+            res = search_shard(con, terms, pignore, file_mode, limit)
+            format_result(
+                db,
+                limit_matches(stop_progress(con, res), file_mode),
+                search,
+                file_mode,
+            )
 
 
-def sort_format_result(db, res_set, search):
+def format_result(db, res, search, file_mode=False):
+    """Print the matches as they arrive, they are ordered by path and line.
+    The duplicates are looked up for batches of files, the batches grow to
+    _sql_chunk files so the first files are printed early"""
     dirname = None
-    old_file = -1
-    for match in sorted(
-            res_set,
-            key=lambda x: (x[0], x[2]),
-    ):
-        file_ = match[1]
-        if file_ != old_file and old_file != -1:
-            display_duplicates(db, old_file)
-        old_file = file_
-        path = match[0]
-        encoding = match[3]
-        try:
-            with codecs.open(path, "r", encoding=encoding) as f:
-                if not _args.raw:
-                    new_dirname = os.path.dirname(path)
-                    if not new_dirname:
-                        new_dirname = "."
-                    if dirname != new_dirname:
-                        dirname = new_dirname
-                        print("%s:" % (
-                            colored(os.path.relpath(dirname, _cwd), "yellow")
-                        ))
-                    file_name = os.path.basename(path)
-                else:
-                    file_name = path
-                context = _args.context
-                if context == 1 or _args.raw:
-                    display_no_context(f, match, path, file_name, search)
-                else:
-                    display_context(f, context, match, path, file_name)
-        except (OSError, IOError):
-            if _args.raw:
+    batch   = []
+    size    = 1
+    # File ids are per shard, the path identifies the file
+    for path, matches in itertools.groupby(res, key=lambda x: x[0]):
+        batch.append((path, list(matches)))
+        if len(batch) >= size:
+            dirname = display_files(db, batch, search, file_mode, dirname)
+            batch   = []
+            if not current_args().raw:
+                size = min(size * 2, _sql_chunk)
+    display_files(db, batch, search, file_mode, dirname)
+
+
+def display_files(db, batch, search, file_mode, dirname):
+    """Print the matches and duplicates of a batch of files (path, matches).
+    Returns the directory of the last file"""
+    if current_args().raw:
+        duplicates = {}
+    else:
+        duplicates = find_duplicates(db, [x[0] for x in batch])
+    for path, matches in batch:
+        if file_mode:
+            print(os.path.relpath(path, current_cwd()))
+        else:
+            dirname = display_file(path, matches, search, dirname)
+        display_duplicates(duplicates.get(path))
+        sys.stdout.flush()
+    return dirname
+
+
+def display_file(path, matches, search, dirname):
+    """Print the matches of a file, the file is read once. Returns the
+    directory of the file"""
+    args    = current_args()
+    context = 1 if args.raw else args.context
+    offset  = int(math.floor(context / 2))
+    wanted  = set()
+    for match in matches:
+        start = match[2] - offset
+        wanted.update(range(start, start + context))
+    try:
+        lines = read_lines(path, matches[0][3], wanted)
+    except (OSError, IOError):
+        for match in matches:
+            if args.raw:
                 print("%s\0%5d\0%s" % (
                     os.path.abspath(path),
                     match[2],
@@ -1091,21 +3515,37 @@ def sort_format_result(db, res_set, search):
                 ))
             else:
                 print("%s:%5d:%s" % (
-                    os.path.relpath(path, _cwd),
+                    os.path.relpath(path, current_cwd()),
                     match[2],
                     "!! File not found "
                 ))
-    display_duplicates(db, old_file)
+        return dirname
+    if not args.raw:
+        new_dirname = os.path.dirname(path)
+        if not new_dirname:
+            new_dirname = "."
+        if dirname != new_dirname:
+            dirname = new_dirname
+            print("%s:" % (
+                colored(os.path.relpath(dirname, current_cwd()), "yellow")
+            ))
+        file_name = os.path.basename(path)
+    else:
+        file_name = path
+    for match in matches:
+        if context == 1:
+            display_no_context(lines, match, file_name, search)
+        else:
+            display_context(lines, context, match, file_name)
+    return dirname
 
 
-def display_context(f, context, match, path, file_name):
+def display_context(lines, context, match, file_name):
     offset = int(math.floor(context / 2))
     context_list = []
     for x in range(context):
         x -= offset
-        context_list.append(
-            get_line(path, match[2] + x, f)
-        )
+        context_list.append(lines.get(match[2] + x, ""))
     strip_list = []
     inside = False
     # Cleaning emtpy lines
@@ -1128,18 +3568,31 @@ def display_context(f, context, match, path, file_name):
     ))
 
 
-def display_no_context(f, match, path, file_name, search):
-    if _args.raw:
+def display_no_context(lines, match, file_name, search):
+    line = lines.get(match[2], "")[:-1]
+    if current_args().raw:
         print("%s\0%5d\0%s" % (
             os.path.abspath(file_name),
             match[2],
-            get_line(path, match[2], f)[:-1]
+            line
         ))
     else:
-        line = get_line(path, match[2], f)[:-1]
         iterms = set()
         for term in search:
-            iterms.update(re.findall(term, line, re.I))
+            flags = 0
+            if grep_mode():
+                term = grep_regex(term)
+            else:
+                flags = re.I
+                if is_pattern(term):
+                    term = "".join([
+                        {"*": r"\w*", "?": r"\w"}.get(x, re.escape(x))
+                        for x in term
+                    ])
+            iterms.update([
+                x.group(0) for x in re.finditer(term, line, flags)
+                if x.group(0)
+            ])
         for term in iterms:
             line = line.replace(term, colored(term, 'red'))
         print("%s:%s:%s" % (
@@ -1149,16 +3602,338 @@ def display_no_context(f, match, path, file_name, search):
         ))
 
 
-def display_duplicates(db, file_):
-    if _args.raw:
+def find_duplicates(db, paths):
+    """Find the duplicates of the files in one query per shard and chunk of
+    paths. Returns a dict path -> paths of the files with the same
+    content"""
+    shards = collections.defaultdict(list)
+    for path in paths:
+        shards[path_shard(path)].append(path)
+    res = collections.defaultdict(list)
+    for shard, shard_paths in six.iteritems(shards):
+        con = shard_con(db, shard)
+        for pos in range(0, len(shard_paths), _sql_chunk):
+            chunk = shard_paths[pos:pos + _sql_chunk]
+            query = _find_duplicates.format(
+                paths=", ".join(["?"] * len(chunk))
+            )
+            for path, dup_path in con.execute(query, chunk):
+                res[path].append(dup_path)
+    return res
+
+
+def display_duplicates(dups):
+    if dups:
+        print("duplicates:")
+        for file_path in dups:
+            print("\t%s" % os.path.relpath(file_path, current_cwd()))
+
+# Query daemon
+
+
+def servable(args):
+    """The daemon only answers searches, everything that writes the index
+    runs in the client"""
+    return bool(args.search) and not (
+        args.index or
+        args.update or
+        args.vacuum or
+        args.clear_inodes or
+        args.bulk or
+        args.batch or
+        args.stats_json or
+        args.serve or
+        args.help
+    )
+
+
+def request_state(name):
+    """State of the request the current thread answers, None outside the
+    daemon"""
+    if _request is None:
+        return None
+    return getattr(_request, name, None)
+
+
+def request_context():
+    """The state of the current request, for the threads of the request"""
+    if _request is None:
+        return {}
+    return dict(_request.__dict__)
+
+
+def enter_request(request):
+    """Answer the request in the current thread"""
+    for name, value in request.items():
+        setattr(_request, name, value)
+
+
+def current_args():
+    """Arguments of the current request, else of the command line"""
+    args = request_state("args")
+    if args is None:
+        return _args
+    return args
+
+
+def current_cwd():
+    """Working directory of the client of the current request"""
+    cwd = request_state("cwd")
+    if cwd is None:
+        return _cwd
+    return cwd
+
+
+def send_frame(conn, kind, data):
+    """Frames are a kind (o: stdout, e: stderr, x: exit status), the length
+    and the data"""
+    import struct
+    conn.sendall(struct.pack("!cI", kind, len(data)) + data)
+
+
+class RequestOutput(object):
+    """stdout of a request, written to the client in frames"""
+
+    def __init__(self, conn, isatty):
+        self.conn   = conn
+        self.tty    = isatty
+        self.buffer = []
+        self.size   = 0
+
+    def write(self, text):
+        if isinstance(text, six.text_type):
+            text = text.encode("UTF-8")
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= _serve_frame:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            send_frame(self.conn, b"o", b"".join(self.buffer))
+            self.buffer = []
+            self.size   = 0
+
+    def isatty(self):
+        return self.tty
+
+
+class ThreadStdout(object):
+    """sys.stdout of the daemon, a thread answering a request writes to its
+    client"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def target(self):
+        return request_state("out") or self.stdout
+
+    def write(self, text):
+        self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+class ServeHandle(object):
+    """Connections of the daemon to the index, used by one request at a
+    time"""
+
+    def __init__(self):
+        # The inode is read first, if --bulk replaces FINJA meanwhile the
+        # handle is only reopened once too often
+        self.inode       = os.stat(_db_path).st_ino
+        con              = open_db(_db_path, threads=True)
+        self.shards      = get_key(DatabaseKey.SHARDS, con) or 1
+        self.db          = (con, TokenDict(con))
+        self.shard_cons  = {}
+        self.search_cons = {}
+
+    def close(self):
+        self.db[0].close()
+        for con in (
+                list(self.shard_cons.values()) +
+                list(self.search_cons.values())
+        ):
+            con.close()
+
+
+def checkout_handle():
+    """An idle handle of the daemon or a new one. Handles of a FINJA --bulk
+    replaced are closed"""
+    global _shards
+    inode  = os.stat(_db_path).st_ino
+    handle = None
+    with _serve_lock:
+        while _serve_idle and handle is None:
+            handle = _serve_idle.pop()
+            if handle.inode != inode:
+                handle.close()
+                handle = None
+    if handle is None:
+        handle = ServeHandle()
+    _shards = handle.shards  # noqa
+    return handle
+
+
+def checkin_handle(handle):
+    with _serve_lock:
+        _serve_idle.append(handle)
+
+
+def request_error(message):
+    """argparse prints errors and exits, the client shows them itself"""
+    raise ValueError(message)
+
+
+def serve_request(parser, conn):
+    """Run the search of a client, the output and the exit status are sent
+    in frames. The client runs requests the daemon doesn't answer itself"""
+    import json
+    import traceback
+    conn.settimeout(_serve_timeout)
+    line = conn.makefile("rb").readline()
+    if not line:
+        # serve() checking for a running daemon
         return
-    con = db[0]
-    with con:
-        res = con.execute(_find_duplicates, (file_, file_)).fetchall()
-        if res:
-            print("duplicates:")
-            for file_path in res:
-                print("\t%s" % os.path.relpath(file_path[0], _cwd))
+    request = json.loads(line.decode("UTF-8"))
+    argv    = request["argv"]
+    if six.PY2:
+        argv = [x.encode("UTF-8") for x in argv]
+    try:
+        args = parser.parse_args(argv)
+    except ValueError:
+        args = None
+    if args is None or not servable(args):
+        conn.sendall(b"local\n")
+        return
+    conn.sendall(b"ok\n")
+    conn.settimeout(_serve_output_timeout)
+    out    = RequestOutput(conn, request.get("isatty", False))
+    handle = checkout_handle()
+    enter_request({
+        "args": args,
+        "cwd": request["cwd"],
+        "out": out,
+        "handle": handle,
+    })
+    status = b"0"
+    try:
+        search(args.search, args.pignore or [], file_mode=args.file_mode)
+        out.flush()
+    except Exception:
+        status = b"1"
+        send_frame(conn, b"e", traceback.format_exc().encode("UTF-8"))
+    finally:
+        checkin_handle(handle)
+    send_frame(conn, b"x", status)
+
+
+def serve_connection(parser, conn):
+    """Thread answering a connection"""
+    import socket
+    import traceback
+    try:
+        serve_request(parser, conn)
+    except (IOError, socket.error):
+        # The client went away or timed out
+        pass
+    except Exception:
+        traceback.print_exc()
+    finally:
+        conn.close()
+
+
+def serve():
+    """Answer the searches of finjac on FINJA.sock until interrupted, each
+    connection in its own thread"""
+    global _request
+    global _serve_lock
+    global _serving
+    import socket
+    import threading
+    os.chdir(find_finja())
+    if os.path.exists(_socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(_socket_path)
+        except socket.error:
+            # Left over by a daemon that was killed
+            os.unlink(_socket_path)
+        else:
+            raise ValueError("A daemon is already serving %s" % _socket_path)
+        finally:
+            probe.close()
+    _serving    = True  # noqa
+    _request    = threading.local()  # noqa
+    _serve_lock = threading.Lock()  # noqa
+    checkin_handle(checkout_handle())
+    parser       = make_parser()
+    parser.error = request_error
+    stdout       = sys.stdout
+    sys.stdout   = ThreadStdout(stdout)
+    sock         = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(_socket_path)
+    sock.listen(16)
+    try:
+        while True:
+            conn, _ = sock.accept()
+            thread  = threading.Thread(
+                target=serve_connection,
+                args=(parser, conn),
+            )
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(_socket_path)
+        sys.stdout = stdout
+        with _serve_lock:
+            for handle in _serve_idle:
+                handle.close()
+            del _serve_idle[:]
+
+
+def read_reply(sock):
+    """Read the first line of the daemon's reply, byte by byte so nothing
+    of the output is buffered"""
+    line = b""
+    while not line.endswith(b"\n"):
+        data = sock.recv(1)
+        if not data:
+            break
+        line += data
+    return line
+
+
+def read_frames(sock):
+    """Write the output frames of the daemon to stdout and stderr. Returns
+    the exit status"""
+    import struct
+    reader = sock.makefile("rb")
+    out    = getattr(sys.__stdout__, "buffer", sys.__stdout__)
+    err    = getattr(sys.__stderr__, "buffer", sys.__stderr__)
+    while True:
+        head = reader.read(5)
+        if len(head) < 5:
+            break
+        kind, size = struct.unpack("!cI", head)
+        data = reader.read(size)
+        if len(data) < size:
+            break
+        if kind == b"x":
+            return int(data)
+        stream = out if kind == b"o" else err
+        stream.write(data)
+        stream.flush()
+    err.write(b"finjac: the daemon closed the connection\n")
+    return 1
+
 
 # Main functions (also for helpers)
 
@@ -1183,55 +3958,74 @@ def grep_main():
             )
 
 
-def reduplicate(db, last_file_path, to_duplicate):
-    con = db[0]
-    res = con.execute(
-        _find_file, (os.path.relpath(last_file_path),)
-    ).fetchall()
-    if res:
-        file_     = res[0][0]
-        with con:
-            dups = con.execute(
-                _find_duplicates, (file_, file_)
-            ).fetchall()
-            for dup_file_path in dups:
-                for dup in to_duplicate:
-                    sys.stdout.write("%s\0%s\0%s" % (
-                        os.path.abspath(dup_file_path[0]),
-                        dup[0],
-                        dup[1]
-                    ))
+def reduplicate(db, batch):
+    """Write the lines of a batch of files (path, lines) followed by the
+    lines repeated for each duplicate of the file"""
+    dups = find_duplicates(db, [os.path.relpath(x[0]) for x in batch])
+    for file_path, lines in batch:
+        for line in lines:
+            sys.stdout.write(line)
+        for dup_file_path in dups.get(os.path.relpath(file_path), []):
+            for line in lines:
+                _, lineno, text = line.split('\0', 2)
+                sys.stdout.write("%s\0%s\0%s" % (
+                    os.path.abspath(dup_file_path),
+                    lineno,
+                    text
+                ))
 
 
 def dup_main():
     finja = find_finja()
     os.chdir(finja)
     db = get_db()
-    to_duplicate = []
-    last_file_path = "."
-    for line in sys.stdin.readlines():
-        (
-            file_path,
-            lineno,
-            text
-        ) = line.split('\0')
-        if last_file_path != file_path:
-            if not last_file_path:
-                last_file_path = "."
-            reduplicate(db, last_file_path, to_duplicate)
-            to_duplicate = []
-            last_file_path = file_path
-        to_duplicate.append((lineno, text))
-        sys.stdout.write(line)
-    reduplicate(db, last_file_path, to_duplicate)
-
-
-def main(argv=None):
-    """Parse the args and excute"""
-    global _args
-    global _cache_size
-    if not argv:  # pragma: no cover
-        argv = sys.argv[1:]
+    batch = []
+    for file_path, lines in itertools.groupby(
+            sys.stdin.readlines(),
+            key=lambda x: x.split('\0')[0],
+    ):
+        batch.append((file_path, list(lines)))
+        if len(batch) >= _sql_chunk:
+            reduplicate(db, batch)
+            batch = []
+    reduplicate(db, batch)
+
+
+def client_main():
+    """Forward a search to the daemon of the index. Without daemon, and for
+    everything but searches, finja runs in this process"""
+    import json
+    import socket
+    argv = sys.argv[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.join(find_finja(), _socket_path))
+        sock.sendall(json.dumps({
+            "argv": argv,
+            "cwd": _cwd,
+            "isatty": sys.stdout.isatty(),
+        }).encode("UTF-8") + b"\n")
+        reply = read_reply(sock)
+    except (ValueError, socket.error):
+        reply = b""
+    if reply != b"ok\n":
+        sock.close()
+        main(argv)
+        return
+    status = 0
+    try:
+        status = read_frames(sock)
+    except IOError as e:
+        # The reader went away, like head
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        sock.close()
+    sys.exit(status)
+
+
+def make_parser():
+    import argparse
     parser = argparse.ArgumentParser(
         description='Index and find stuff',
         add_help=False
@@ -1240,6 +4034,14 @@ def main(argv=None):
         '--interpunct',
         help='use international seperators',
         action='store_true',
+        default=None,
+    )
+    parser.add_argument(
+        '--no-interpunct',
+        help="don't use international seperators when the index is created "
+             "or rebuilt with --bulk",
+        action='store_false',
+        dest='interpunct',
     )
     parser.add_argument(
         '--index',
@@ -1266,6 +4068,20 @@ def main(argv=None):
         default=1,
         type=int
     )
+    parser.add_argument(
+        '--limit',
+        '-n',
+        help='stop after N matches (files in file-mode). Default 0 '
+             '(disabled)',
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        '--max-per-file',
+        help='show at most N matches per file. Default 0 (disabled)',
+        default=0,
+        type=int
+    )
     parser.add_argument(
         '--raw',
         '-r',
@@ -1273,6 +4089,18 @@ def main(argv=None):
              "(doesn't display duplicates, use finjadup)",
         action='store_true',
     )
+    parser.add_argument(
+        '--quiet',
+        '-q',
+        help="don't print a line per file when indexing",
+        action='store_true',
+    )
+    parser.add_argument(
+        '--stats-json',
+        help='write timings and throughput of the indexing run to a JSON '
+             'file',
+        metavar='PATH',
+    )
     parser.add_argument(
         '--batch',
         '-b',
@@ -1280,6 +4108,75 @@ def main(argv=None):
         default=0,
         type=int
     )
+    parser.add_argument(
+        '--hash',
+        help='content hash used when creating the index. Default: %s' % (
+            _default_hash,
+        ),
+        choices=sorted(_hash_names),
+    )
+    parser.add_argument(
+        '--exclude',
+        help='exclude paths matching a .gitignore style pattern when '
+             'indexing (see FINJA.ignore). Can be repeated',
+        action='append'
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        help='tokenize files in N processes while indexing. Default 1',
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        '--commit-files',
+        help='commit after writing N files. Default 1000',
+        default=1000,
+        type=int
+    )
+    parser.add_argument(
+        '--commit-bytes',
+        help='commit after reading N bytes. Default 64MiB',
+        default=64 * 1024 * 1024,
+        type=int
+    )
+    parser.add_argument(
+        '--bulk',
+        help='reindex everything into a new database that replaces the '
+             'index when it is done, faster for big trees. Use with -i',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--shards',
+        help='number of shards of a new index, the shards are indexed and '
+             'searched in parallel. Changing it needs --bulk. Default: 1',
+        type=int,
+    )
+    parser.add_argument(
+        '--trigrams',
+        help='also index the trigrams of the files, makes --substring and '
+             '--regex fast. Adding it to an index needs --bulk',
+        action='store_true',
+        default=None,
+    )
+    parser.add_argument(
+        '--no-trigrams',
+        help='rebuild the index without trigrams. Use with --bulk',
+        action='store_false',
+        dest='trigrams',
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--substring',
+        help='find lines containing the search strings (case-sensitive)',
+        action='store_true',
+    )
+    group.add_argument(
+        '--regex',
+        help='find lines matching the search strings as Python regular '
+             'expressions (case-sensitive)',
+        action='store_true',
+    )
     parser.add_argument(
         '--pignore',
         '-p',
@@ -1290,9 +4187,15 @@ def main(argv=None):
     parser.add_argument(
         '--vacuum',
         '-v',
-        help='rebuild the whole database to make it smaller',
+        help='delete orphaned entries and make the database smaller',
         action='store_true',
     )
+    parser.add_argument(
+        '--vacuum-seconds',
+        help='time budget of --vacuum. Default: 10',
+        default=10,
+        type=float
+    )
     parser.add_argument(
         '--less-memory',
         '-l',
@@ -1301,8 +4204,15 @@ def main(argv=None):
     )
     parser.add_argument(
         '--clear-inodes',
-        help='reset all inodes and modification dates, '
-             'will cause finja to rescan everything. Use with -i or -u',
+        help='reset all file signatures (inodes, sizes and modification '
+             'dates), will cause finja to rehash everything. Use with -i or '
+             '-u',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--serve',
+        help='answer the searches of finjac on FINJA.sock, keeps the index '
+             'open and its caches warm',
         action='store_true',
     )
     parser.add_argument(
@@ -1324,6 +4234,18 @@ def main(argv=None):
             help='search string',
             nargs='*',
         )
+    return parser
+
+
+def main(argv=None):
+    """Parse the args and excute"""
+    global _args
+    global _cache_size
+    global _cache_bytes
+    global _bulk_cache
+    if not argv:  # pragma: no cover
+        argv = sys.argv[1:]
+    parser = make_parser()
     args = parser.parse_args(argv)
     if args.help:
         print(logo)
@@ -1332,6 +4254,11 @@ def main(argv=None):
     _args = args  # noqa
     if args.less_memory:
         _cache_size = int(_cache_size / 100)  # noqa
+        _cache_bytes = int(_cache_bytes / 100)  # noqa
+        _bulk_cache = int(_bulk_cache / 100)  # noqa
+    if args.serve:
+        serve()
+        return
     if args.index:
         index()
     if not args.pignore:
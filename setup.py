@@ -15,6 +15,9 @@ _install_requires = [
 if sys.version_info < (2, 7):
     _install_requires.append("argparse")
 
+if sys.version_info < (3, 5):
+    _install_requires.append("scandir")
+
 __version__  = None
 version_file = "finja/version.py"
 with open(version_file) as f:
@@ -33,7 +36,8 @@ setup(
             "finja=finja:main",
             "finjacol=finja:col_main",
             "finjagrep=finja:grep_main",
-            "finjadup=finja:dup_main"
+            "finjadup=finja:dup_main",
+            "finjac=finja:client_main",
         ]
     },
     install_requires = _install_requires,